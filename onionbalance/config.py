@@ -17,6 +17,13 @@ REFRESH_INTERVAL = 10 * 60
 PUBLISH_CHECK_INTERVAL = 5 * 60
 INITIAL_DELAY = 45  # Wait for instance descriptors before publishing
 
+# Also upload to the HSDirs from the previous consensus for this long
+# after a new consensus arrives
+HSDIR_GRACE_PERIOD = 60 * 60
+
+# Halve the weight of older HSDir fetch and upload outcomes this often
+HSDIR_LEDGER_HALF_LIFE = 6 * 60 * 60
+
 LOG_LOCATION = os.environ.get('ONIONBALANCE_LOG_LOCATION')
 LOG_LEVEL = os.environ.get('ONIONBALANCE_LOG_LEVEL', 'info')
 
@@ -29,6 +36,31 @@ TOR_CONTROL_PASSWORD = None
 TOR_CONTROL_SOCKET = os.environ.get('ONIONBALANCE_TOR_CONTROL_SOCKET',
                                     '/var/run/tor/control')
 
+# Read the HSDir list from the consensus cached in this Tor DataDirectory
+# instead of requesting it over the control port.
+TOR_DATA_DIRECTORY = os.environ.get('ONIONBALANCE_TOR_DATA_DIRECTORY')
+
+# Save the HSDir ring to this file so it can be reused after a restart
+CONSENSUS_SNAPSHOT_LOCATION = os.environ.get(
+    'ONIONBALANCE_CONSENSUS_SNAPSHOT_LOCATION')
+
+# Number of worker processes used to sign descriptors. Descriptors are
+# signed in the main process when set to 0.
+SIGNING_WORKERS = 0
+
+# Number of descriptor signatures kept so identical descriptors are not
+# signed again
+SIGNATURE_CACHE_SIZE = 256
+
+# Number of threads processing received instance descriptors, and of
+# processes parsing them. Descriptors are processed in the Tor event thread
+# when INGEST_WORKERS is 0.
+INGEST_WORKERS = 1
+INGEST_PROCESSES = 0
+
+# Maximum number of received descriptors waiting to be processed
+INGEST_QUEUE_SIZE = 1000
+
 # Upload multiple distinct descriptors containing different subsets of
 # the available introduction points
 DISTINCT_DESCRIPTORS = True
@@ -36,4 +68,8 @@ DISTINCT_DESCRIPTORS = True
 # Store global data about onion services and their instance nodes.
 services = []
 
+# Instances of all services keyed by onion address. An instance may be
+# configured under more than one service.
+instances_by_address = {}
+
 controller = None
@@ -2,9 +2,15 @@
 """
 This module provides a set of functions for reading Tor consensus documents.
 """
-from bisect import bisect_left
+import collections
 import base64
 import binascii
+import calendar
+import mmap
+import os
+import struct
+import threading
+import time
 
 import stem
 import stem.descriptor
@@ -14,16 +20,318 @@ import onionbalance.config as config
 
 logger = log.get_logger()
 
-HSDIR_LIST = []
+# Length of a HSDir identity fingerprint in bytes
+FINGERPRINT_LEN = 20
+
+# Consensus documents cached by Tor in its DataDirectory
+CONSENSUS_CACHE_FILES = ['cached-microdesc-consensus', 'cached-consensus']
+
+# Header of the on-disk HSDir ring snapshot: magic, valid-after and
+# valid-until timestamps followed by the packed ring buffer.
+SNAPSHOT_MAGIC = b'OBHSDIR1'
+SNAPSHOT_HEADER = struct.Struct('>8sQQ')
+
+
+def _hex_fingerprint(digest):
+    return binascii.hexlify(digest).decode('utf-8').upper()
+
+
+class HSDirRing(object):
+    """
+    Sorted ring of HSDir identity fingerprints
+
+    The fingerprints are stored as packed 20 byte digests in a single
+    contiguous buffer, lookups search the buffer directly. Indexing or
+    iterating over the ring returns uppercase hex fingerprints, which are
+    only encoded for the HSDirs returned.
+
+    The `valid_after` and `valid_until` times of the consensus the ring
+    was built from are stored as Unix timestamps, or None if unknown.
+    """
+
+    def __init__(self, fingerprints=None, valid_after=None,
+                 valid_until=None):
+        digests = set(binascii.unhexlify(fingerprint)
+                      for fingerprint in fingerprints or [])
+        self._buffer = b''.join(sorted(digests))
+        self.valid_after = valid_after
+        self.valid_until = valid_until
+
+    @classmethod
+    def from_buffer(cls, buffer, valid_after=None, valid_until=None):
+        """
+        Create a ring from a buffer of sorted, packed fingerprint digests
+        """
+        if len(buffer) % FINGERPRINT_LEN:
+            raise ValueError("HSDir ring buffer is not a multiple of %d "
+                             "bytes." % FINGERPRINT_LEN)
+        ring = cls(valid_after=valid_after, valid_until=valid_until)
+        ring._buffer = bytes(buffer)
+        return ring
+
+    def is_valid(self, now=None):
+        """
+        Check if the consensus this ring was built from is still valid
+        """
+        if not self.valid_until:
+            return False
+        return (now or time.time()) < self.valid_until
+
+    def __len__(self):
+        return len(self._buffer) // FINGERPRINT_LEN
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("HSDir ring index out of range")
+        return self._fingerprint(index)
+
+    def __iter__(self):
+        return (self._fingerprint(index) for index in range(len(self)))
+
+    def __contains__(self, fingerprint):
+        digest = binascii.unhexlify(fingerprint)
+        index = self.bisect(digest)
+        return index < len(self) and self.digest(index) == digest
+
+    @property
+    def buffer(self):
+        return self._buffer
+
+    def digest(self, index):
+        """
+        Return the packed fingerprint digest at `index`
+        """
+        start = index * FINGERPRINT_LEN
+        return self._buffer[start:start + FINGERPRINT_LEN]
+
+    def digests(self):
+        return [self.digest(index) for index in range(len(self))]
+
+    def _fingerprint(self, index):
+        return _hex_fingerprint(self.digest(index))
+
+    def bisect(self, digest, lo=0):
+        """
+        Find the position of the first fingerprint >= `digest`
+        """
+        buffer = self._buffer
+        hi = len(buffer) // FINGERPRINT_LEN
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = mid * FINGERPRINT_LEN
+            if buffer[start:start + FINGERPRINT_LEN] < digest:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _select(self, position, count):
+        """
+        Pick `count` consecutive HSDirs from `position`, wrapping around the
+        edge of the ring. A HSDir is never chosen more than once.
+        """
+        ring_size = len(self)
+        return [self._fingerprint((position + offset) % ring_size)
+                for offset in range(min(count, ring_size))]
+
+    def responsible(self, digest, count):
+        """
+        Get the `count` HSDirs responsible for a descriptor ID digest
+        """
+        return self._select(self.bisect(digest), count)
+
+    def responsible_many(self, digests, count):
+        """
+        Get the responsible HSDirs for a list of descriptor ID digests
+
+        Each digest is looked up in turn, the results are returned in the
+        same order as `digests`.
+        """
+        return [self.responsible(digest, count) for digest in digests]
+
+    def apply(self, joined, left):
+        """
+        Return a new ring with the `joined` fingerprints inserted and the
+        `left` fingerprints removed.
+
+        Only the changed positions are searched, the unchanged runs of the
+        buffer are copied across as they are.
+        """
+        changes = []
+        for fingerprint in left:
+            digest = binascii.unhexlify(fingerprint)
+            index = self.bisect(digest)
+            if index < len(self) and self.digest(index) == digest:
+                changes.append((index, 1, None))
+        for fingerprint in joined:
+            digest = binascii.unhexlify(fingerprint)
+            changes.append((self.bisect(digest), 0, digest))
+
+        pieces = []
+        position = 0
+        for index, removed, digest in sorted(changes):
+            pieces.append(self._buffer[position * FINGERPRINT_LEN:
+                                       index * FINGERPRINT_LEN])
+            position = index
+            if removed:
+                position += 1
+            else:
+                pieces.append(digest)
+        pieces.append(self._buffer[position * FINGERPRINT_LEN:])
+        return HSDirRing.from_buffer(b''.join(pieces))
+
+
+HSDIR_LIST = HSDirRing()
+
+# The ring from the previous consensus. Clients which have not fetched the
+# new consensus yet will still query the HSDirs responsible in this ring.
+PREVIOUS_HSDIR_LIST = HSDirRing()
+
+# Time when the current ring replaced the previous ring
+HSDIR_LIST_UPDATED = None
+
+_refresh_lock = threading.Lock()
+
+HSDirChanges = collections.namedtuple('HSDirChanges', ['joined', 'left'])
+
+# HSDir fingerprints which joined and left the list in the last update
+HSDIR_CHANGES = HSDirChanges(joined=frozenset(), left=frozenset())
+
+# Incremented each time a new HSDir list is loaded from the consensus
+CONSENSUS_GENERATION = 0
+
+HSDirCacheInfo = collections.namedtuple(
+    'HSDirCacheInfo', ['generation', 'hits', 'misses', 'currsize'])
+
+
+class ResponsibleHSDirCache(object):
+    """
+    Cache of the responsible HSDirs for each descriptor ID
+
+    The cached lookups are only valid for a single HSDir ring. Callers
+    pass the ring they looked up, the cache is dropped when a lookup is
+    made with a different ring. Lookups computed from a ring which has been
+    replaced in the meantime are not stored.
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self._lookups = {}
+        self._key = None
+        self._lock = threading.Lock()
+
+    def _validate(self, hsdir_ring):
+        """
+        Drop the cached lookups if they were made with a different ring
+        """
+        key = (hsdir_ring, config.HSDIR_SET)
+        if (self._key is None or self._key[0] is not key[0] or
+                self._key[1] != key[1]):
+            self._lookups = {}
+            self._key = key
+
+    def get(self, hsdir_ring, descriptor_id):
+        """
+        Return the cached responsible HSDirs in `hsdir_ring` or None if not
+        cached
+        """
+        with self._lock:
+            self._validate(hsdir_ring)
+            responsible_hsdirs = self._lookups.get(descriptor_id)
+            if responsible_hsdirs is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            return list(responsible_hsdirs)
+
+    def get_many(self, hsdir_ring, descriptor_ids):
+        """
+        Return a list of the cached responsible HSDirs in `hsdir_ring` for
+        each descriptor ID, with None for the IDs which are not cached
+        """
+        with self._lock:
+            self._validate(hsdir_ring)
+            results = [self._lookups.get(descriptor_id)
+                       for descriptor_id in descriptor_ids]
+            misses = results.count(None)
+            self.misses += misses
+            self.hits += len(results) - misses
+        return [None if responsible_hsdirs is None
+                else list(responsible_hsdirs)
+                for responsible_hsdirs in results]
+
+    def set_many(self, hsdir_ring, lookups):
+        """
+        Store (descriptor_id, responsible_hsdirs) pairs for `hsdir_ring`
+        """
+        with self._lock:
+            if hsdir_ring is not HSDIR_LIST:
+                return None
+            self._validate(hsdir_ring)
+            for descriptor_id, responsible_hsdirs in lookups:
+                self._lookups[descriptor_id] = tuple(responsible_hsdirs)
+
+    def set(self, hsdir_ring, descriptor_id, responsible_hsdirs):
+        """
+        Store the responsible HSDirs for a descriptor ID in `hsdir_ring`
+        """
+        with self._lock:
+            if hsdir_ring is not HSDIR_LIST:
+                return None
+            self._validate(hsdir_ring)
+            self._lookups[descriptor_id] = tuple(responsible_hsdirs)
+
+    def info(self):
+        return HSDirCacheInfo(generation=CONSENSUS_GENERATION,
+                              hits=self.hits, misses=self.misses,
+                              currsize=len(self._lookups))
+
+
+hsdir_cache = ResponsibleHSDirCache()
 
 
 def refresh_consensus():
     """
     Update consensus state when Tor receives a new network status
 
-    Retrieve the current set of hidden service directories
+    Retrieve the current set of hidden service directories and apply the
+    changes to the HSDir list. Returns a HSDirChanges tuple listing the
+    HSDirs which joined and left.
+
+    If TOR_DATA_DIRECTORY is configured the HSDirs are read directly from
+    Tor's cached consensus file, falling back to the control port if the
+    file cannot be read.
     """
-    global HSDIR_LIST
+    # Only one refresh should build and swap in a new ring at a time
+    with _refresh_lock:
+        changes = _load_consensus()
+        if changes is not None and config.CONSENSUS_SNAPSHOT_LOCATION:
+            try:
+                save_snapshot(config.CONSENSUS_SNAPSHOT_LOCATION, HSDIR_LIST)
+            except (IOError, OSError) as err:
+                logger.warning("Could not write the HSDir ring snapshot: %s",
+                               err)
+        return changes
+
+
+def _load_consensus():
+    if config.TOR_DATA_DIRECTORY:
+        consensus_path = find_consensus_file(config.TOR_DATA_DIRECTORY)
+        if consensus_path:
+            try:
+                hsdir_ring = load_hsdir_ring(consensus_path)
+            except (IOError, OSError, ValueError) as err:
+                logger.warning("Could not read the cached consensus %s: %s",
+                               consensus_path, err)
+            else:
+                return _log_hsdir_changes(update_hsdir_list(hsdir_ring))
+        else:
+            logger.warning("No cached consensus found in the Tor data "
+                           "directory %s.", config.TOR_DATA_DIRECTORY)
 
     if not config.controller:
         logger.warning("Controller connection not found in the configuration. "
@@ -34,50 +342,391 @@ def refresh_consensus():
 
     # pylint: disable=no-member
     # Retrieve the current set of hidden service directories
-    hsdirs = []
+    hsdirs = set()
     try:
         for desc in controller.get_network_statuses():
             if stem.Flag.HSDIR in desc.flags:
-                hsdirs.append(desc.fingerprint)
+                hsdirs.add(desc.fingerprint)
     except IOError as err:
         logger.error("Could not load consensus from Tor: %s" % err)
+        return None
+
+    # Consensus validity times are only available from newer Tor versions
+    try:
+        valid_times = controller.get_info(['consensus/valid-after',
+                                           'consensus/valid-until'])
+        valid_after = _parse_consensus_time(
+            valid_times['consensus/valid-after'])
+        valid_until = _parse_consensus_time(
+            valid_times['consensus/valid-until'])
+    except (stem.ControllerError, ValueError):
+        valid_after, valid_until = None, None
+
+    return _log_hsdir_changes(update_hsdir_list(hsdirs, valid_after,
+                                                valid_until))
+
+
+class ConsensusRefresher(object):
+    """
+    Refresh the consensus in a dedicated background thread
+
+    The new HSDir ring is built off the event dispatch thread and swapped
+    in once complete. Refresh requests which arrive while a refresh is
+    running are coalesced into a single follow-up refresh.
+    """
+
+    def __init__(self):
+        self._pending = threading.Event()
+        self._idle = threading.Event()
+        self._idle.set()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._callbacks = []
+
+    def add_callback(self, callback):
+        """
+        Call `callback` with the HSDirChanges after each refresh which
+        changed the HSDir ring
+        """
+        self._callbacks.append(callback)
+
+    def request_refresh(self):
+        """
+        Schedule a consensus refresh and return immediately
+        """
+        with self._lock:
+            self._idle.clear()
+            self._pending.set()
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run,
+                                                name="consensus-refresh")
+                self._thread.daemon = True
+                self._thread.start()
+
+    def wait_idle(self, timeout=None):
+        """
+        Wait until all requested refreshes have completed
+        """
+        return self._idle.wait(timeout)
+
+    def _run(self):
+        while True:
+            self._pending.wait()
+            self._pending.clear()
+            try:
+                changes = refresh_consensus()
+                if changes and (changes.joined or changes.left):
+                    for callback in self._callbacks:
+                        callback(changes)
+            except Exception:
+                logger.exception("An unexpected exception occured when "
+                                 "refreshing the consensus.")
+
+            with self._lock:
+                if not self._pending.is_set():
+                    self._idle.set()
+
+
+refresher = ConsensusRefresher()
+
+
+def _log_hsdir_changes(changes):
+    logger.debug("Updated the list of Tor hidden service directories "
+                 "(%d joined, %d left).", len(changes.joined),
+                 len(changes.left))
+    return changes
+
+
+def find_consensus_file(data_directory):
+    """
+    Find the most recently modified cached consensus in a Tor DataDirectory
+    """
+    cached_consensuses = []
+    for filename in CONSENSUS_CACHE_FILES:
+        path = os.path.join(data_directory, filename)
+        try:
+            cached_consensuses.append((os.path.getmtime(path), path))
+        except OSError:
+            continue
+
+    if not cached_consensuses:
+        return None
+    return max(cached_consensuses)[1]
+
+
+def load_hsdir_ring(consensus_path):
+    """
+    Build a HSDir ring directly from a cached consensus file
+
+    The consensus is memory-mapped and streamed line by line. Only the
+    router `r` lines and their `s` flag lines are inspected, the identity
+    of each router with the HSDir flag is packed straight into the ring.
+    """
+    digests = []
+    identity = None
+    valid_after, valid_until = None, None
+    with open(consensus_path, 'rb') as consensus_file:
+        consensus_map = mmap.mmap(consensus_file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+        try:
+            for line in iter(consensus_map.readline, b''):
+                if line.startswith(b'valid-after '):
+                    valid_after = _parse_consensus_time(line[12:])
+                elif line.startswith(b'valid-until '):
+                    valid_until = _parse_consensus_time(line[12:])
+                elif line.startswith(b'r '):
+                    # r nickname identity ...
+                    identity = line.split(b' ', 3)[2]
+                elif line.startswith(b's ') and identity:
+                    if b'HSDir' in line.split():
+                        # Identities are base64 encoded without padding
+                        digests.append(base64.b64decode(identity + b'='))
+                    identity = None
+                elif line.startswith(b'directory-footer'):
+                    break
+        finally:
+            consensus_map.close()
+
+    return HSDirRing.from_buffer(b''.join(sorted(set(digests))),
+                                 valid_after=valid_after,
+                                 valid_until=valid_until)
+
+
+def _parse_consensus_time(value):
+    """
+    Convert a consensus timestamp to a Unix timestamp
+    """
+    if isinstance(value, bytes):
+        value = value.decode('utf-8')
+    return calendar.timegm(time.strptime(value.strip(), "%Y-%m-%d %H:%M:%S"))
+
+
+def save_snapshot(snapshot_path, hsdir_ring):
+    """
+    Write a HSDir ring and its validity times to a compact snapshot file
+
+    The snapshot is written to a temporary file first and then renamed into
+    place so a partially written snapshot is never loaded.
+    """
+    if not hsdir_ring or not hsdir_ring.valid_until:
+        logger.debug("Not writing a HSDir ring snapshot, the consensus "
+                     "validity time is not known.")
+        return False
+
+    temporary_path = snapshot_path + '.tmp'
+    with open(temporary_path, 'wb') as snapshot_file:
+        snapshot_file.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC,
+                                                 hsdir_ring.valid_after or 0,
+                                                 hsdir_ring.valid_until))
+        snapshot_file.write(hsdir_ring.buffer)
+    os.rename(temporary_path, snapshot_path)
+    logger.debug("Wrote HSDir ring snapshot to %s.", snapshot_path)
+    return True
+
+
+def load_snapshot(snapshot_path):
+    """
+    Load a HSDir ring snapshot, returning None if the snapshot is missing,
+    corrupt or its consensus is no longer valid.
+    """
+    try:
+        with open(snapshot_path, 'rb') as snapshot_file:
+            snapshot = snapshot_file.read()
+    except (IOError, OSError):
+        return None
+
+    try:
+        magic, valid_after, valid_until = SNAPSHOT_HEADER.unpack_from(
+            snapshot)
+        if magic != SNAPSHOT_MAGIC:
+            raise ValueError("Unknown snapshot format.")
+        hsdir_ring = HSDirRing.from_buffer(snapshot[SNAPSHOT_HEADER.size:],
+                                           valid_after=valid_after or None,
+                                           valid_until=valid_until)
+    except (struct.error, ValueError) as err:
+        logger.warning("Could not load the HSDir ring snapshot %s: %s",
+                       snapshot_path, err)
+        return None
+
+    if not hsdir_ring.is_valid():
+        logger.debug("The HSDir ring snapshot %s has expired.",
+                     snapshot_path)
+        return None
+    return hsdir_ring
+
+
+def restore_snapshot():
+    """
+    Load the HSDir ring saved by a previous run if it is still valid
+
+    Allows the first descriptors to be published immediately after a
+    restart while the live consensus is loaded in the background.
+    """
+    if not config.CONSENSUS_SNAPSHOT_LOCATION:
+        return False
+
+    hsdir_ring = load_snapshot(config.CONSENSUS_SNAPSHOT_LOCATION)
+    if not hsdir_ring:
+        return False
+
+    with _refresh_lock:
+        update_hsdir_list(hsdir_ring)
+    logger.info("Loaded %d HSDirs from the snapshot %s.", len(hsdir_ring),
+                config.CONSENSUS_SNAPSHOT_LOCATION)
+    return True
+
+
+def update_hsdir_list(hsdirs, valid_after=None, valid_until=None):
+    """
+    Apply the difference between the current HSDir list and a new set of
+    HSDir fingerprints or a complete HSDirRing.
+
+    The consensus validity times are stored on the new ring when a set
+    of fingerprints is provided.
+
+    Only the HSDirs which joined or left are inserted into or removed from
+    the HSDir ring. The new ring is swapped in once complete so lookups
+    never see a partially updated ring.
+    """
+    global HSDIR_LIST, HSDIR_CHANGES, CONSENSUS_GENERATION
+    global PREVIOUS_HSDIR_LIST, HSDIR_LIST_UPDATED
+
+    if isinstance(hsdirs, HSDirRing):
+        # A complete ring was built already, only compute the changes
+        digests = set(hsdirs.digests())
+        current_digests = set(HSDIR_LIST.digests())
+        joined = frozenset(_hex_fingerprint(digest)
+                           for digest in digests - current_digests)
+        left = frozenset(_hex_fingerprint(digest)
+                         for digest in current_digests - digests)
+        hsdir_list = hsdirs
     else:
-        HSDIR_LIST = hsdirs
-        logger.debug("Updated the list of Tor hidden service directories.")
+        hsdirs = set(fingerprint.upper() for fingerprint in hsdirs)
+        current_hsdirs = set(HSDIR_LIST)
+        joined = frozenset(hsdirs - current_hsdirs)
+        left = frozenset(current_hsdirs - hsdirs)
+
+        if not HSDIR_LIST:
+            # Nothing to apply a delta to, build the ring from scratch
+            hsdir_list = HSDirRing(hsdirs)
+        else:
+            hsdir_list = HSDIR_LIST.apply(joined, left)
+        hsdir_list.valid_after = valid_after
+        hsdir_list.valid_until = valid_until
+
+    if HSDIR_LIST:
+        PREVIOUS_HSDIR_LIST = HSDIR_LIST
+        HSDIR_LIST_UPDATED = time.time()
+
+    # Swap in the ring together with its generation number
+    HSDIR_LIST, CONSENSUS_GENERATION = hsdir_list, CONSENSUS_GENERATION + 1
+    HSDIR_CHANGES = HSDirChanges(joined=joined, left=left)
+    return HSDIR_CHANGES
 
 
 def get_hsdirs(descriptor_id):
     """
     Get the responsible HSDirs for a given descriptor ID.
+
+    Lookups are cached until a new consensus is loaded.
     """
+    # The ring may be swapped by the refresh thread, use the same ring for
+    # the lookup and the cache.
+    hsdir_ring = _ensure_hsdir_list()
 
-    # Try fetch a consensus if we haven't loaded one already
-    if not HSDIR_LIST:
-        refresh_consensus()
+    responsible_hsdirs = hsdir_cache.get(hsdir_ring, descriptor_id)
+    if responsible_hsdirs is not None:
+        return responsible_hsdirs
 
-    if not HSDIR_LIST:
-        raise ValueError('Could not determine the responsible HSDirs.')
+    responsible_hsdirs = hsdir_ring.responsible(
+        base64.b32decode(descriptor_id, 1), config.HSDIR_SET)
 
-    desc_id_bytes = base64.b32decode(descriptor_id, 1)
-    descriptor_id_hex = (binascii.hexlify(desc_id_bytes).
-                         decode('utf-8').upper())
+    hsdir_cache.set(hsdir_ring, descriptor_id, responsible_hsdirs)
+    return responsible_hsdirs
 
-    responsible_hsdirs = []
 
-    # Find postion of descriptor ID in the HSDir list
-    index = descriptor_position = bisect_left(HSDIR_LIST, descriptor_id_hex)
+def get_previous_hsdirs(descriptor_id):
+    """
+    Get the HSDirs which were responsible for a descriptor ID in the
+    previous consensus but are not responsible in the current consensus.
 
-    # Pick HSDirs until we have enough
-    while len(responsible_hsdirs) < config.HSDIR_SET:
-        try:
-            responsible_hsdirs.append(HSDIR_LIST[index])
-            index += 1
-        except IndexError:
-            # Wrap around when we reach the end of the HSDir list
-            index = 0
+    HSDirs from the previous ring are only returned for
+    HSDIR_GRACE_PERIOD seconds after the new consensus was loaded.
+    """
+    previous_hsdir_list = PREVIOUS_HSDIR_LIST
+    if not previous_hsdir_list or not HSDIR_LIST_UPDATED:
+        return []
 
-        # Do not choose a HSDir more than once
-        if index == descriptor_position:
-            break
+    if time.time() - HSDIR_LIST_UPDATED > config.HSDIR_GRACE_PERIOD:
+        return []
 
-    return responsible_hsdirs
+    current_hsdirs = get_hsdirs(descriptor_id)
+    previous_hsdirs = previous_hsdir_list.responsible(
+        base64.b32decode(descriptor_id, 1), config.HSDIR_SET)
+    return [hsdir for hsdir in previous_hsdirs
+            if hsdir not in current_hsdirs]
+
+
+def get_new_hsdirs(descriptor_id):
+    """
+    Get the HSDirs which are responsible for a descriptor ID in the current
+    consensus but were not responsible in the previous consensus.
+    """
+    previous_hsdir_list = PREVIOUS_HSDIR_LIST
+    if not previous_hsdir_list:
+        return []
+
+    previous_hsdirs = previous_hsdir_list.responsible(
+        base64.b32decode(descriptor_id, 1), config.HSDIR_SET)
+    return [hsdir for hsdir in get_hsdirs(descriptor_id)
+            if hsdir not in previous_hsdirs]
+
+
+def get_hsdirs_with_previous(descriptor_id):
+    """
+    Get the union of the responsible HSDirs in the current consensus and,
+    during the grace period, in the previous consensus.
+
+    HSDirs which are responsible in both rings are only returned once.
+    """
+    return get_hsdirs(descriptor_id) + get_previous_hsdirs(descriptor_id)
+
+
+def get_hsdirs_many(descriptor_ids):
+    """
+    Get the responsible HSDirs for a list of descriptor IDs.
+
+    Returns a list of responsible HSDir lists in the same order as
+    `descriptor_ids`. The cache is consulted and updated once for all of
+    the descriptor IDs.
+    """
+    hsdir_ring = _ensure_hsdir_list()
+
+    results = hsdir_cache.get_many(hsdir_ring, descriptor_ids)
+    missing = [index for index, responsible_hsdirs in enumerate(results)
+               if responsible_hsdirs is None]
+
+    digests = [base64.b32decode(descriptor_ids[index], 1)
+               for index in missing]
+    lookups = hsdir_ring.responsible_many(digests, config.HSDIR_SET)
+    for index, responsible_hsdirs in zip(missing, lookups):
+        results[index] = responsible_hsdirs
+    hsdir_cache.set_many(hsdir_ring, [(descriptor_ids[index], results[index])
+                                      for index in missing])
+
+    return results
+
+
+def _ensure_hsdir_list():
+    """
+    Try fetch a consensus if we haven't loaded one already
+
+    Returns the current HSDir ring.
+    """
+    if not HSDIR_LIST:
+        refresh_consensus()
+
+    hsdir_ring = HSDIR_LIST
+    if not hsdir_ring:
+        raise ValueError('Could not determine the responsible HSDirs.')
+    return hsdir_ring
@@ -6,6 +6,8 @@ import textwrap
 import datetime
 import random
 import itertools
+import collections
+import time
 
 import Crypto.Util.number
 import stem
@@ -16,6 +18,33 @@ from onionbalance import config
 
 logger = log.get_logger()
 
+# Signature blocks as bytes keyed by the SHA1 digest of the signed
+# descriptor text. The size is updated from the config when the management
+# server starts.
+signature_cache = util.LRUCache(config.SIGNATURE_CACHE_SIZE)
+
+# Onion addresses of the instance descriptors processed recently keyed by
+# the SHA1 digest of the raw descriptor. Instances republish an identical
+# descriptor until their introduction points change.
+received_descriptors = util.LRUCache(1024)
+
+# Onion addresses keyed by the PEM permanent key block of the instance
+# descriptors received. The permanent key of an instance never changes.
+permanent_key_addresses = util.LRUCache(1024)
+
+# Introduction points decoded ahead of time with an authentication cookie
+DecodedIntroductionPoints = collections.namedtuple(
+    'DecodedIntroductionPoints', ['authentication_cookie',
+                                  'introduction_points'])
+
+# Descriptor body ending with the "signature" line, and its SHA1 digest
+UnsignedDescriptor = collections.namedtuple('UnsignedDescriptor',
+                                            ['body', 'digest'])
+
+# Serialized introduction point text keyed by introduction point identifier.
+# Each entry stores the IntroductionPoint object it was generated from.
+_intro_point_fragments = {}
+
 
 class IntroductionPointSet(object):
     """
@@ -28,22 +57,62 @@ class IntroductionPointSet(object):
 
     This class tracks which introduction points have already been provided
     and tries to provide the most diverse set of IPs.
+
+    An optional list of `weights`, one for each backend instance, gives
+    each instance a share of the introduction points in every selection
+    proportional to its weight.
     """
 
-    def __init__(self, available_introduction_points):
+    def __init__(self, available_introduction_points, weights=None):
+        if weights is None:
+            weights = [1] * len(available_introduction_points)
+
         # Shuffle the introduction point order before selecting IPs.
         # Randomizing now allows later calls to .choose() to be
-        # deterministic.
-        for instance_intro_points in available_introduction_points:
+        # deterministic. The shuffled snapshot is a copy, the lists
+        # provided by the instances are not modified.
+        snapshot = []
+        for instance_intro_points, weight in zip(
+                available_introduction_points, weights):
+            instance_intro_points = list(instance_intro_points)
             random.shuffle(instance_intro_points)
-        random.shuffle(available_introduction_points)
-
-        self.available_intro_points = available_introduction_points
-        self.intro_point_generator = self.get_intro_point()
+            snapshot.append((tuple(instance_intro_points), weight))
+        random.shuffle(snapshot)
+
+        self.available_intro_points = tuple(ips for ips, _ in snapshot)
+        self.weights = tuple(weight for _, weight in snapshot)
+
+        # Weighted selection is only needed when the weights differ.
+        # Each instance keeps a cursor to its next introduction point and
+        # the instance which wins rounding ties rotates with each selection.
+        self.weighted = len(set(self.weights)) > 1
+        self._cursors = [0] * len(self.available_intro_points)
+        self._tie_break = 0
+
+        # Combine intro points from across the backend instances breadth
+        # first and flatten
+        missing = object()
+        self._intro_points = tuple(
+            intro_point for intro_point in itertools.chain.from_iterable(
+                zip_longest(*self.available_intro_points, fillvalue=missing))
+            if intro_point is not missing)
+        self._position = 0
 
     def __len__(self):
         """Provide the total number of available introduction points"""
-        return sum(len(ips) for ips in self.available_intro_points)
+        return len(self._intro_points)
+
+    def selection_key(self):
+        """
+        Identify the available introduction points of each instance and
+        the instance weights, independent of the order they were shuffled
+        into
+        """
+        return tuple(sorted(
+            (tuple(sorted(intro_point.identifier for intro_point in ips)),
+             weight)
+            for ips, weight in zip(self.available_intro_points,
+                                   self.weights)))
 
     def get_intro_point(self):
         """
@@ -54,13 +123,7 @@ class IntroductionPointSet(object):
         intro point set is wrapped in `itertools.cycle` and will provided
         an infinite series of introduction points.
         """
-
-        # Combine intro points from across the backend instances and flatten
-        intro_points = zip_longest(*self.available_intro_points)
-        flat_intro_points = itertools.chain.from_iterable(intro_points)
-        for intro_point in itertools.cycle(flat_intro_points):
-            if intro_point:
-                yield intro_point
+        return itertools.cycle(self._intro_points)
 
     def choose(self, count=10, shuffle=True):
         """
@@ -68,32 +131,243 @@ class IntroductionPointSet(object):
 
         Where more than `count` IPs are available, introduction points are
         selected to try and achieve the greatest distribution of introduction
-        points across all of the available backend instances.
+        points across all of the available backend instances. Each call
+        continues from where the previous selection ended.
 
         Return a list of IntroductionPoints.
         """
 
         # Limit `count` to the available number of IPs to avoid repeats.
-        count = min(len(self), count)
-        choosen_ips = list(itertools.islice(self.intro_point_generator, count))
+        total = len(self._intro_points)
+        count = min(total, count)
+        if self.weighted:
+            choosen_ips = self._choose_weighted(count)
+            if shuffle:
+                random.shuffle(choosen_ips)
+            return choosen_ips
+
+        start = self._position
+        end = start + count
+
+        choosen_ips = list(self._intro_points[start:end])
+        if end > total:
+            choosen_ips.extend(self._intro_points[:end - total])
+        self._position = end % total if total else 0
 
         if shuffle:
             random.shuffle(choosen_ips)
         return choosen_ips
 
+    def apportion(self, count, tie_break=0, capacities=None):
+        """
+        Split `count` introduction point slots between the instances in
+        proportion to their weights
+
+        Uses the largest remainder method. No instance is given more slots
+        than its capacity, by default its number of introduction points,
+        the slots it cannot fill are shared between the other instances.
+        Remainders which are equal are won by instances in order starting
+        at index `tie_break`.
+        """
+        num_instances = len(self.available_intro_points)
+        if capacities is None:
+            capacities = [len(ips) for ips in self.available_intro_points]
+        allocation = [0] * num_instances
+        remaining = count
+
+        while remaining > 0:
+            open_instances = [i for i in range(num_instances)
+                              if self.weights[i] > 0 and
+                              allocation[i] < capacities[i]]
+            if not open_instances:
+                break
+
+            total_weight = float(sum(self.weights[i]
+                                     for i in open_instances))
+            quotas = dict((i, remaining * self.weights[i] / total_weight)
+                          for i in open_instances)
+            for i in open_instances:
+                share = min(int(quotas[i]), capacities[i] - allocation[i])
+                allocation[i] += share
+                remaining -= share
+
+            by_remainder = sorted(
+                open_instances,
+                key=lambda i: (int(quotas[i]) - quotas[i],
+                               (i - tie_break) % num_instances))
+            for i in by_remainder:
+                if not remaining:
+                    break
+                if allocation[i] < capacities[i]:
+                    allocation[i] += 1
+                    remaining -= 1
+
+        return allocation
+
+    def _choose_weighted(self, count):
+        allocation = self.apportion(count, self._tie_break)
+        self._tie_break += 1
+
+        choosen_ips = []
+        for index, slots in enumerate(allocation):
+            instance_intro_points = self.available_intro_points[index]
+            cursor = self._cursors[index]
+            for offset in range(slots):
+                choosen_ips.append(instance_intro_points[
+                    (cursor + offset) % len(instance_intro_points)])
+            if slots:
+                self._cursors[index] = ((cursor + slots) %
+                                        len(instance_intro_points))
+        return choosen_ips
+
+    def assign(self, num_descriptors, count=10, shuffle=True):
+        """
+        Choose the introduction points for `num_descriptors` distinct
+        descriptors of up to `count` introduction points each
+
+        The assignment is planned for all descriptors together. The slots
+        of all descriptors are first split between the instances by weight,
+        then each instance's slots are dealt out evenly across the
+        descriptors. Each instance fills its slots with consecutive runs of
+        its introduction points, so as many distinct introduction points as
+        possible are exposed and no descriptor repeats an introduction
+        point.
+
+        Returns a list of `num_descriptors` lists of IntroductionPoints.
+        """
+        count = min(len(self), count)
+        if not num_descriptors or not count:
+            return [[] for _ in range(num_descriptors)]
+
+        # Total appearances of each instance across every descriptor. An
+        # introduction point can only appear once in each descriptor.
+        totals = self.apportion(
+            num_descriptors * count, self._tie_break,
+            capacities=[len(ips) * num_descriptors
+                        for ips in self.available_intro_points])
+        self._tie_break += 1
+
+        descriptors = [[] for _ in range(num_descriptors)]
+        extra_slot = 0
+        for index, total in enumerate(totals):
+            instance_intro_points = self.available_intro_points[index]
+            if not total:
+                continue
+
+            # Every descriptor gets the base share, the remaining slots are
+            # dealt out round-robin continuing from the previous instance
+            # so each descriptor ends up with `count` slots.
+            base, extra = divmod(total, num_descriptors)
+            extra_descriptors = set((extra_slot + i) % num_descriptors
+                                    for i in range(extra))
+            extra_slot = (extra_slot + extra) % num_descriptors
+
+            cursor = self._cursors[index]
+            for descriptor_index, intro_points in enumerate(descriptors):
+                slots = base + (descriptor_index in extra_descriptors)
+                for offset in range(slots):
+                    intro_points.append(instance_intro_points[
+                        (cursor + offset) % len(instance_intro_points)])
+                cursor = (cursor + slots) % len(instance_intro_points)
+            self._cursors[index] = cursor
+
+        if shuffle:
+            for intro_points in descriptors:
+                random.shuffle(intro_points)
+        return descriptors
+
+
+class ServiceKeyMaterial(collections.namedtuple('ServiceKeyMaterial', [
+        'key', 'permanent_key_block', 'permanent_id', 'onion_address',
+        'next_rotation'])):
+    """
+    Values derived from a service key which are needed for every descriptor
+
+    `next_rotation` is the Unix timestamp when the descriptor ID of the
+    service next changes.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_key(cls, key, now=None):
+        """
+        Derive the key material for the RSA service key `key`
+        """
+        permanent_id = util.calc_permanent_id(key)
+        return cls(
+            key=key,
+            permanent_key_block=make_public_key_block(key),
+            permanent_id=permanent_id,
+            onion_address=base64.b32encode(permanent_id).decode().lower(),
+            next_rotation=cls._next_rotation(permanent_id, now),
+        )
+
+    @staticmethod
+    def _next_rotation(permanent_id, now=None):
+        if now is None:
+            now = time.time()
+        return int(now) + util.get_seconds_valid(now, permanent_id)
+
+    def seconds_valid(self, now=None):
+        """
+        Seconds until the descriptor ID of the service changes
+        """
+        if now is None:
+            now = time.time()
+        return self.next_rotation - int(now)
+
+    def refreshed(self, now=None):
+        """
+        Return the key material with `next_rotation` moved forward once the
+        descriptor ID has changed
+        """
+        if self.seconds_valid(now) > 0:
+            return self
+        return self._replace(
+            next_rotation=self._next_rotation(self.permanent_id, now))
+
 
 def generate_service_descriptor(permanent_key, introduction_point_list=None,
                                 replica=0, timestamp=None, deviation=0):
     """
     High-level interface for generating a signed HS descriptor
+
+    `permanent_key` is the ServiceKeyMaterial of the service, or its RSA
+    key from which the key material is derived.
+    """
+    if not isinstance(permanent_key, ServiceKeyMaterial):
+        permanent_key = ServiceKeyMaterial.from_key(permanent_key)
+
+    unsigned_descriptor = generate_unsigned_service_descriptor(
+        permanent_key,
+        introduction_point_list=introduction_point_list,
+        replica=replica,
+        timestamp=timestamp,
+        deviation=deviation,
+    )
+    signature_block = get_signature_block(unsigned_descriptor.digest,
+                                          permanent_key.key)
+    return (unsigned_descriptor.body + signature_block).decode('utf-8')
+
+
+def generate_unsigned_service_descriptor(key_material,
+                                         introduction_point_list=None,
+                                         replica=0, timestamp=None,
+                                         deviation=0):
+    """
+    Generate a HS descriptor which is ready to be signed with
+    `sign_descriptor` or `signing.sign_descriptors`
+
+    Returns an UnsignedDescriptor with the descriptor body as bytes and
+    its SHA1 digest.
     """
 
     if not timestamp:
         timestamp = datetime.datetime.utcnow()
     unix_timestamp = int(timestamp.strftime("%s"))
 
-    permanent_key_block = make_public_key_block(permanent_key)
-    permanent_id = util.calc_permanent_id(permanent_key)
+    permanent_key_block = key_material.permanent_key_block
+    permanent_id = key_material.permanent_id
 
     # Calculate the current secret-id-part for this hidden service
     # Deviation allows the generation of a descriptor for a different time
@@ -105,16 +379,15 @@ def generate_service_descriptor(permanent_key, introduction_point_list=None,
     descriptor_id = util.calc_descriptor_id(permanent_id, secret_id_part)
 
     if not introduction_point_list:
-        onion_address = util.calc_onion_address(permanent_key)
         raise ValueError("No introduction points for service %s.onion." %
-                         onion_address)
+                         key_material.onion_address)
 
     # Generate the introduction point section of the descriptor
-    intro_section = make_introduction_points_part(
+    intro_section = _make_introduction_points_part(
         introduction_point_list
     )
 
-    unsigned_descriptor = generate_hs_descriptor_raw(
+    return _assemble_descriptor(
         desc_id_base32=util.base32_encode_str(descriptor_id),
         permanent_key_block=permanent_key_block,
         secret_id_part_base32=util.base32_encode_str(secret_id_part),
@@ -122,17 +395,15 @@ def generate_service_descriptor(permanent_key, introduction_point_list=None,
         introduction_points_part=intro_section
     )
 
-    signed_descriptor = sign_descriptor(unsigned_descriptor, permanent_key)
-    return signed_descriptor
-
 
-def generate_hs_descriptor_raw(desc_id_base32, permanent_key_block,
-                               secret_id_part_base32, publication_time,
-                               introduction_points_part):
+def _assemble_descriptor(desc_id_base32, permanent_key_block,
+                         secret_id_part_base32, publication_time,
+                         introduction_points_part):
     """
-    Generate hidden service descriptor string
+    Write the descriptor body into a single buffer, hashing each part as
+    it is added
     """
-    doc = [
+    head = '\n'.join([
         "rendezvous-service-descriptor {}".format(desc_id_base32),
         "version 2",
         "permanent-key",
@@ -140,13 +411,53 @@ def generate_hs_descriptor_raw(desc_id_base32, permanent_key_block,
         "secret-id-part {}".format(secret_id_part_base32),
         "publication-time {}".format(publication_time),
         "protocol-versions 2,3",
-        "introduction-points",
-        introduction_points_part,
-        "signature\n",
-    ]
+        "introduction-points\n",
+    ]).encode('utf-8')
+
+    body = bytearray()
+    digest = hashlib.sha1()
+    for part in (head, introduction_points_part, b'\nsignature\n'):
+        body += part
+        digest.update(part)
+    return UnsignedDescriptor(bytes(body), digest.digest())
+
+
+def generate_hs_descriptor_raw(desc_id_base32, permanent_key_block,
+                               secret_id_part_base32, publication_time,
+                               introduction_points_part):
+    """
+    Generate hidden service descriptor string
+    """
+    unsigned_descriptor = _assemble_descriptor(
+        desc_id_base32, permanent_key_block, secret_id_part_base32,
+        publication_time, introduction_points_part.encode('utf-8'))
+    return unsigned_descriptor.body.decode('utf-8')
+
+
+def _wrap_base64(data):
+    """
+    Base64 encode bytes and wrap them into lines of 64 characters
+    """
+    encoded = base64.b64encode(data)
+    return b'\n'.join([encoded[i:i + 64]
+                       for i in range(0, len(encoded), 64)])
+
 
-    unsigned_descriptor = '\n'.join(doc)
-    return unsigned_descriptor
+def _make_introduction_points_part(introduction_point_list):
+    # Serialize the introduction points in a canonical order so a
+    # descriptor republished with the same introduction points is identical
+    # and its signature can be reused. Clients pick from the introduction
+    # points at random, the order in the descriptor is not significant.
+    intro_fragments = [serialize_introduction_point(intro_point)
+                       for intro_point in sorted(
+                           introduction_point_list,
+                           key=lambda intro_point: intro_point.identifier)]
+
+    # Add the header and footer:
+    return b'\n'.join([
+        b'-----BEGIN MESSAGE-----',
+        _wrap_base64(b'\n'.join(intro_fragments)),
+        b'-----END MESSAGE-----'])
 
 
 def make_introduction_points_part(introduction_point_list=None):
@@ -158,26 +469,42 @@ def make_introduction_points_part(introduction_point_list=None):
     if not introduction_point_list:
         introduction_point_list = []
 
-    intro = []
-    for intro_point in introduction_point_list:
-        intro.append("introduction-point {}".format(intro_point.identifier))
-        intro.append("ip-address {}".format(intro_point.address))
-        intro.append("onion-port {}".format(intro_point.port))
-        intro.append("onion-key")
-        intro.append(intro_point.onion_key)
-        intro.append("service-key")
-        intro.append(intro_point.service_key)
+    return _make_introduction_points_part(
+        introduction_point_list).decode('utf-8')
 
-    intro_section = '\n'.join(intro).encode('utf-8')
-    intro_section_base64 = base64.b64encode(intro_section).decode('utf-8')
-    intro_section_base64 = textwrap.fill(intro_section_base64, 64)
 
-    # Add the header and footer:
-    intro_points_with_headers = '\n'.join([
-        '-----BEGIN MESSAGE-----',
-        intro_section_base64,
-        '-----END MESSAGE-----'])
-    return intro_points_with_headers
+def serialize_introduction_point(intro_point):
+    """
+    Get the descriptor text for an IntroductionPoint object as bytes
+
+    The text is cached by introduction point identifier until it is evicted
+    with `evict_introduction_points`.
+    """
+    cached = _intro_point_fragments.get(intro_point.identifier)
+    if cached and cached[0] is intro_point:
+        return cached[1]
+
+    fragment = '\n'.join([
+        "introduction-point {}".format(intro_point.identifier),
+        "ip-address {}".format(intro_point.address),
+        "onion-port {}".format(intro_point.port),
+        "onion-key",
+        intro_point.onion_key,
+        "service-key",
+        intro_point.service_key,
+    ]).encode('utf-8')
+    _intro_point_fragments[intro_point.identifier] = (intro_point, fragment)
+    return fragment
+
+
+def evict_introduction_points(introduction_points):
+    """
+    Remove the cached descriptor text for a list of IntroductionPoints
+    """
+    for intro_point in introduction_points:
+        cached = _intro_point_fragments.get(intro_point.identifier)
+        if cached and cached[0] is intro_point:
+            _intro_point_fragments.pop(intro_point.identifier, None)
 
 
 def make_public_key_block(key):
@@ -196,31 +523,49 @@ def make_public_key_block(key):
     return pub_with_headers
 
 
-def sign_digest(digest, private_key):
+def make_signature_block(digest, private_key):
     """
-    Sign, base64 encode, wrap and add Tor signature headers
+    Sign, base64 encode, wrap and add Tor signature headers, as bytes
 
     The message digest is PKCS1 padded without the optional
     algorithmIdentifier section.
     """
 
-    digest = util.add_pkcs1_padding(digest)
-    (signature_long, ) = private_key.sign(digest, None)
-    signature_bytes = Crypto.Util.number.long_to_bytes(signature_long, 128)
-    signature_base64 = base64.b64encode(signature_bytes).decode('utf-8')
-    signature_base64 = textwrap.fill(signature_base64, 64)
+    signature_bytes = util.get_crypto_backend().sign(private_key, digest)
 
     # Add the header and footer:
-    signature_with_headers = '\n'.join([
-        '-----BEGIN SIGNATURE-----',
-        signature_base64,
-        '-----END SIGNATURE-----'])
-    return signature_with_headers
+    return b'\n'.join([
+        b'-----BEGIN SIGNATURE-----',
+        _wrap_base64(signature_bytes),
+        b'-----END SIGNATURE-----'])
 
 
-def sign_descriptor(descriptor, service_key):
+def get_signature_block(digest, private_key):
     """
-    Sign or resign a provided hidden service descriptor
+    Return the signature block for a descriptor digest, reusing the
+    signature of an identical descriptor signed before
+    """
+    signature_block = signature_cache.get(digest)
+    if signature_block is None:
+        signature_block = make_signature_block(digest, private_key)
+        signature_cache.set(digest, signature_block)
+    return signature_block
+
+
+def sign_digest(digest, private_key):
+    """
+    Sign, base64 encode, wrap and add Tor signature headers
+
+    The message digest is PKCS1 padded without the optional
+    algorithmIdentifier section.
+    """
+    return make_signature_block(digest, private_key).decode('utf-8')
+
+
+def strip_signature(descriptor):
+    """
+    Return the descriptor text which is signed, ending with the
+    "signature" keyword line
     """
     token_descriptor_signature = '\nsignature\n'
 
@@ -230,36 +575,101 @@ def sign_descriptor(descriptor, service_key):
                                 len(token_descriptor_signature)]
     else:
         descriptor = descriptor.strip() + token_descriptor_signature
+    return descriptor
+
 
+def sign_descriptor(descriptor, service_key):
+    """
+    Sign or resign a provided hidden service descriptor
+    """
+    descriptor = strip_signature(descriptor)
     descriptor_digest = hashlib.sha1(descriptor.encode('utf-8')).digest()
-    signature_with_headers = sign_digest(descriptor_digest, service_key)
-    return descriptor + signature_with_headers
 
+    # An identical descriptor does not need to be signed again
+    signature_block = get_signature_block(descriptor_digest, service_key)
+    return descriptor + signature_block.decode('utf-8')
+
+
+def parse_descriptor(descriptor_content, authentication_cookie=None,
+                     decode_introduction_points=False):
+    """
+    Parse and validate an instance descriptor
+
+    Returns the parsed descriptor and, when `decode_introduction_points` is
+    set, a DecodedIntroductionPoints tuple with its introduction points
+    decoded using `authentication_cookie`. The introduction points are None
+    if they were not decoded or could not be decoded.
 
-def descriptor_received(descriptor_content):
+    Raises ValueError if the descriptor is invalid.
+    """
+    parsed_descriptor = stem.descriptor.hidden_service_descriptor.\
+        HiddenServiceDescriptor(descriptor_content, validate=True)
+    if not decode_introduction_points:
+        return parsed_descriptor, None
+
+    # A failure is left for the instance to report when it decodes the
+    # introduction points itself.
+    try:
+        introduction_points = parsed_descriptor.introduction_points(
+            authentication_cookie=authentication_cookie)
+    except Exception:
+        return parsed_descriptor, None
+    return parsed_descriptor, DecodedIntroductionPoints(
+        authentication_cookie, introduction_points)
+
+
+def descriptor_received(descriptor_content, parser=parse_descriptor):
     """
     Process onion service descriptors retrieved from the HSDir system or
     received directly over the metadata channel.
+
+    A descriptor identical to one processed before is not parsed again, the
+    matching instances are only marked as received. New descriptors are
+    parsed with `parser`, which behaves like `parse_descriptor`.
     """
+    if isinstance(descriptor_content, bytes):
+        content_digest = hashlib.sha1(descriptor_content).digest()
+    else:
+        content_digest = hashlib.sha1(
+            descriptor_content.encode('utf-8')).digest()
+
+    onion_address = received_descriptors.get(content_digest)
+    if onion_address is not None:
+        instances = config.instances_by_address.get(onion_address)
+        if instances:
+            logger.debug("Received an unchanged descriptor for instance "
+                         "%s.onion.", onion_address)
+            received = datetime.datetime.utcnow()
+            for instance in instances:
+                instance.received = received
+            return None
 
     try:
-        parsed_descriptor = stem.descriptor.hidden_service_descriptor.\
-            HiddenServiceDescriptor(descriptor_content, validate=True)
+        parsed_descriptor, decoded_introduction_points = parser(
+            descriptor_content)
     except ValueError:
         logger.exception("Received an invalid service descriptor.")
         return None
 
     # Ensure the received descriptor matches the requested descriptor
-    permanent_key = Crypto.PublicKey.RSA.importKey(
+    descriptor_onion_address = permanent_key_addresses.get(
         parsed_descriptor.permanent_key)
-    descriptor_onion_address = util.calc_onion_address(permanent_key)
+    if descriptor_onion_address is None:
+        permanent_key = Crypto.PublicKey.RSA.importKey(
+            parsed_descriptor.permanent_key)
+        descriptor_onion_address = util.calc_onion_address(permanent_key)
+        permanent_key_addresses.set(parsed_descriptor.permanent_key,
+                                    descriptor_onion_address)
 
     known_descriptor, instance_changed = False, False
-    for instance in [instance for service in config.services for
-                     instance in service.instances]:
-        if instance.onion_address == descriptor_onion_address:
-            instance_changed |= instance.update_descriptor(parsed_descriptor)
-            known_descriptor = True
+    for instance in config.instances_by_address.get(
+            descriptor_onion_address, []):
+        instance_changed |= instance.update_descriptor(
+            parsed_descriptor, decoded_introduction_points)
+        known_descriptor = True
+
+    if known_descriptor:
+        received_descriptors.set(content_digest, descriptor_onion_address)
 
     if instance_changed:
         logger.info("The introduction point set has changed for instance "
@@ -276,15 +686,13 @@ def descriptor_received(descriptor_content):
     return None
 
 
-def upload_descriptor(controller, signed_descriptor, hsdirs=None):
+def _hspost_command(signed_descriptor, hsdirs=None):
     """
-    Upload descriptor via the Tor control port
+    Build the HSPOST command for a signed descriptor given as bytes or str
 
-    If no HSDirs are specified, Tor will upload to what it thinks are the
-    responsible directories
+    Stem expects the command as str, a bytes descriptor is decoded together
+    with the command line in one pass.
     """
-    logger.debug("Beginning service descriptor upload.")
-
     # Provide server fingerprints to control command if HSDirs are specified.
     if hsdirs:
         server_args = ' '.join([("SERVER={}".format(hsdir))
@@ -292,9 +700,23 @@ def upload_descriptor(controller, signed_descriptor, hsdirs=None):
     else:
         server_args = ""
 
+    if isinstance(signed_descriptor, bytes):
+        return b''.join([b'HSPOST ', server_args.encode('utf-8'), b'\n',
+                         signed_descriptor]).decode('utf-8')
+    return "HSPOST %s\n%s" % (server_args, signed_descriptor)
+
+
+def upload_descriptor(controller, signed_descriptor, hsdirs=None):
+    """
+    Upload descriptor via the Tor control port
+
+    If no HSDirs are specified, Tor will upload to what it thinks are the
+    responsible directories
+    """
+    logger.debug("Beginning service descriptor upload.")
+
     # Stem will insert the leading + and trailing '\r\n.\r\n'
-    response = controller.msg("HSPOST %s\n%s" %
-                              (server_args, signed_descriptor))
+    response = controller.msg(_hspost_command(signed_descriptor, hsdirs))
 
     (response_code, divider, response_content) = response.content()[0]
     if not response.is_ok():
@@ -7,8 +7,9 @@ import sys
 import stem
 
 from onionbalance import log
-from onionbalance import descriptor
+from onionbalance import ingest
 from onionbalance import consensus
+from onionbalance.ledger import ledger
 
 logger = log.get_logger()
 
@@ -27,9 +28,11 @@ class EventHandler(object):
         # pylint: disable=no-member
         if status_event.status_type == stem.StatusType.GENERAL:
             if status_event.action == "CONSENSUS_ARRIVED":
-                # Update the local view of the consensus in OnionBalance
+                # Update the local view of the consensus in OnionBalance.
+                # The refresh runs in a background thread so descriptor
+                # events are not blocked while the consensus is loaded.
                 try:
-                    consensus.refresh_consensus()
+                    consensus.refresher.request_refresh()
                 except Exception:
                     logger.exception("An unexpected exception occured in the "
                                      "when processing the consensus update "
@@ -42,6 +45,14 @@ class EventHandler(object):
         """
         logger.debug("Received new HS_DESC event: %s", str(desc_event))
 
+        # Keep track of how each HSDir responds to fetches and uploads
+        try:
+            ledger.record_event(desc_event.action,
+                                desc_event.directory_fingerprint)
+        except Exception:
+            logger.exception("An unexpected exception occured when "
+                             "recording the HS_DESC event.")
+
     @staticmethod
     def new_desc_content(desc_content_event):
         """
@@ -63,9 +74,10 @@ class EventHandler(object):
                          desc_content_event.address)
             return None
 
-        # Send content to callback function which will process the descriptor
+        # Queue the descriptor to be processed by the ingest workers
         try:
-            descriptor.descriptor_received(descriptor_text)
+            ingest.ingester.submit(desc_content_event.address,
+                                   descriptor_text)
         except Exception:
             logger.exception("An unexpected exception occured in the "
                              "new descriptor callback.")
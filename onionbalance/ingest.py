@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+"""
+Process received instance descriptors off the Tor event thread
+
+Received descriptors are queued by onion address and processed by a pool
+of worker threads. Parsing and validating the descriptors and decoding
+their introduction points can optionally be done in a pool of worker
+processes.
+"""
+import collections
+import functools
+import multiprocessing
+import signal
+import threading
+import time
+
+from onionbalance import log
+from onionbalance import config
+from onionbalance import descriptor
+
+logger = log.get_logger()
+
+IngestStats = collections.namedtuple('IngestStats', [
+    'depth', 'received', 'processed', 'replaced', 'dropped', 'latency',
+    'processing_time'])
+
+
+def _init_worker():
+    """
+    Leave handling SIGINT to the management server process
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+class DescriptorQueue(object):
+    """
+    Bounded queue holding at most one received descriptor for each onion
+    address
+
+    A descriptor received for an address which is already queued replaces
+    the queued descriptor, keeping its place in the queue. When the queue
+    is full the oldest descriptor is dropped. A descriptor is not handed out
+    while another descriptor for the same address is being processed.
+    """
+
+    # Weight of the newest sample in the latency averages
+    LATENCY_WEIGHT = 0.1
+
+    def __init__(self, maxsize=1000):
+        self.maxsize = maxsize
+        self.received = 0
+        self.processed = 0
+        self.replaced = 0
+        self.dropped = 0
+
+        # Average time from receiving a descriptor until it was processed,
+        # and the average time spent processing it
+        self.latency = None
+        self.processing_time = None
+
+        self._entries = collections.OrderedDict()
+        self._in_progress = set()
+        self._condition = threading.Condition()
+
+    def __len__(self):
+        with self._condition:
+            return len(self._entries)
+
+    def put(self, onion_address, descriptor_content, now=None):
+        """
+        Queue a descriptor received for `onion_address`
+        """
+        if now is None:
+            now = time.time()
+
+        with self._condition:
+            self.received += 1
+            queued = self._entries.get(onion_address)
+            if queued is not None:
+                self._entries[onion_address] = (descriptor_content,
+                                                queued[1])
+                self.replaced += 1
+            else:
+                if len(self._entries) >= self.maxsize:
+                    dropped_address, _ = self._entries.popitem(last=False)
+                    self.dropped += 1
+                    logger.warning("The descriptor queue is full, dropped "
+                                   "the descriptor for instance %s.onion.",
+                                   dropped_address)
+                self._entries[onion_address] = (descriptor_content, now)
+            self._condition.notify_all()
+
+    def get(self, timeout=None):
+        """
+        Remove the oldest descriptor whose address is not being processed
+
+        Returns an (onion_address, descriptor_content, enqueued) tuple, or
+        None if no descriptor became available within `timeout` seconds.
+        `task_done` must be called once the descriptor is processed.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._condition:
+            while True:
+                for onion_address in self._entries:
+                    if onion_address not in self._in_progress:
+                        descriptor_content, enqueued = self._entries.pop(
+                            onion_address)
+                        self._in_progress.add(onion_address)
+                        return onion_address, descriptor_content, enqueued
+
+                if deadline is None:
+                    self._condition.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return None
+                    self._condition.wait(remaining)
+
+    def _average(self, average, sample):
+        if average is None:
+            return sample
+        return average + self.LATENCY_WEIGHT * (sample - average)
+
+    def task_done(self, onion_address, enqueued, started, now=None):
+        """
+        Record that the descriptor for `onion_address` queued at `enqueued`
+        and picked up at `started` has been processed
+        """
+        if now is None:
+            now = time.time()
+
+        with self._condition:
+            self._in_progress.discard(onion_address)
+            self.processed += 1
+            self.latency = self._average(self.latency, now - enqueued)
+            self.processing_time = self._average(self.processing_time,
+                                                 now - started)
+            self._condition.notify_all()
+
+    def stats(self):
+        with self._condition:
+            return IngestStats(len(self._entries), self.received,
+                               self.processed, self.replaced, self.dropped,
+                               self.latency, self.processing_time)
+
+
+class DescriptorIngester(object):
+    """
+    Process received descriptors in a pool of worker threads
+    """
+
+    def __init__(self):
+        self.queue = DescriptorQueue()
+        self.pool = None
+        self._threads = []
+
+    def start(self, workers, processes=0, queue_size=1000):
+        """
+        Start `workers` threads processing queued descriptors, and
+        `processes` processes parsing them.
+
+        Each thread waits for the descriptor it is processing to be parsed,
+        at least one thread is started for every parsing process so all of
+        the processes can be kept busy. Descriptors are processed as soon
+        as they are submitted when both `workers` and `processes` are 0.
+        The parsing processes should be started before any other threads
+        are running as they are forked.
+        """
+        workers = max(workers, processes)
+        if not workers or self._threads:
+            return None
+        self.queue.maxsize = queue_size
+
+        if processes:
+            try:
+                self.pool = multiprocessing.Pool(processes,
+                                                 initializer=_init_worker)
+            except (OSError, ValueError) as exc:
+                logger.warning("Could not start the descriptor parsing "
+                               "pool, descriptors will be parsed in the "
+                               "worker threads: %s", exc)
+
+        for index in range(workers):
+            thread = threading.Thread(target=self._run,
+                                      name="descriptor-ingest-%d" % index)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+        logger.debug("Started %d descriptor processing threads and %d "
+                     "parsing processes.", workers,
+                     processes if self.pool else 0)
+
+    def stop(self):
+        """
+        Stop the parsing processes. The worker threads exit with the
+        management server.
+        """
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
+
+    def submit(self, onion_address, descriptor_content):
+        """
+        Queue a descriptor received for `onion_address`
+        """
+        if not self._threads:
+            return descriptor.descriptor_received(descriptor_content)
+        self.queue.put(onion_address, descriptor_content)
+
+    def _parse(self, descriptor_content, authentication_cookie=None):
+        """
+        Parse a descriptor in the parsing processes, also decoding its
+        introduction points there
+        """
+        pool = self.pool
+        if pool is None:
+            return descriptor.parse_descriptor(descriptor_content)
+        return pool.apply(descriptor.parse_descriptor,
+                          (descriptor_content, authentication_cookie, True))
+
+    def _parser(self, onion_address):
+        """
+        Return the parser for a descriptor received for `onion_address`
+        """
+        instances = config.instances_by_address.get(onion_address)
+        if not instances:
+            return self._parse
+        return functools.partial(
+            self._parse,
+            authentication_cookie=instances[0].authentication_cookie)
+
+    def _run(self):
+        while True:
+            onion_address, descriptor_content, enqueued = self.queue.get()
+            started = time.time()
+            try:
+                descriptor.descriptor_received(
+                    descriptor_content, parser=self._parser(onion_address))
+            except Exception:
+                logger.exception("An unexpected exception occured when "
+                                 "processing the descriptor for %s.onion.",
+                                 onion_address)
+            finally:
+                self.queue.task_done(onion_address, enqueued, started)
+
+
+ingester = DescriptorIngester()
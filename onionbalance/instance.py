@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 import datetime
+import hashlib
 import time
 
 import stem.control
@@ -7,6 +8,8 @@ import stem.control
 from onionbalance import log
 from onionbalance import config
 from onionbalance import util
+from onionbalance import descriptor
+from onionbalance.ingest import ingester
 
 logger = log.get_logger()
 
@@ -17,6 +20,15 @@ def fetch_instance_descriptors(controller):
     """
     logger.info("Initiating fetch of descriptors for all service instances.")
 
+    ingest_stats = ingester.queue.stats()
+    if ingest_stats.received:
+        logger.debug("Descriptor queue: %d queued, %d processed, %d "
+                     "replaced, %d dropped, %.2fs average latency, %.2fs "
+                     "average processing time.", ingest_stats.depth,
+                     ingest_stats.processed, ingest_stats.replaced,
+                     ingest_stats.dropped, ingest_stats.latency or 0.0,
+                     ingest_stats.processing_time or 0.0)
+
     # pylint: disable=no-member
 
     while True:
@@ -31,16 +43,14 @@ def fetch_instance_descriptors(controller):
         else:
             break
 
-    unique_instances = set(instance for service in config.services
-                           for instance in service.instances)
-
     # Only try to retrieve the descriptor once for each unique instance
     # address. An instance may be configured under multiple master
     # addressed. We do not want to request the same instance descriptor
     # multiple times.
     # OnionBalance will update all of the matching instances when a
     # descriptor is received.
-    for instance in unique_instances:
+    for instances in config.instances_by_address.values():
+        instance = instances[0]
         while True:
             try:
                 instance.fetch_descriptor()
@@ -57,12 +67,17 @@ class Instance(object):
     Instance represents a back-end load balancing hidden service.
     """
 
-    def __init__(self, controller, onion_address, authentication_cookie=None):
+    def __init__(self, controller, onion_address, authentication_cookie=None,
+                 weight=1):
         """
         Initialise an Instance object.
         """
         self.controller = controller
 
+        # Relative capacity of this instance when introduction points are
+        # selected for the master descriptors
+        self.weight = weight
+
         # Onion address for the service instance.
         if onion_address:
             onion_address = onion_address.replace('.onion', '')
@@ -72,6 +87,10 @@ class Instance(object):
         # Store the latest set of introduction points for this instance
         self.introduction_points = []
 
+        # SHA1 digest of the encoded introduction points they were decoded
+        # from
+        self.introduction_points_digest = None
+
         # Timestamp when last received a descriptor for this instance
         self.received = None
 
@@ -101,13 +120,16 @@ class Instance(object):
             logger.warning("No descriptor received for instance %s.onion, "
                            "the instance may be offline.", self.onion_address)
 
-    def update_descriptor(self, parsed_descriptor):
+    def update_descriptor(self, parsed_descriptor,
+                          decoded_introduction_points=None):
         """
         Update introduction points when a new HS descriptor is received
 
         Parse the descriptor content and update the set of introduction
-        points for this HS instance. Returns True if the introduction
-        point set has changed, False otherwise.`
+        points for this HS instance. Introduction points which were
+        decoded already with this instance's authentication cookie are
+        passed as `decoded_introduction_points`. Returns True if the
+        introduction point set has changed, False otherwise.`
         """
 
         self.received = datetime.datetime.utcnow()
@@ -129,10 +151,27 @@ class Instance(object):
         else:
             self.timestamp = parsed_descriptor.published
 
+        # Skip decoding the introduction points when their encoded form has
+        # not changed since the last descriptor.
+        introduction_points_digest = hashlib.sha1(
+            (parsed_descriptor.introduction_points_encoded or '').encode(
+                'utf-8')).digest()
+        if introduction_points_digest == self.introduction_points_digest:
+            logger.debug("Introduction points for instance %s.onion are "
+                         "unchanged.", self.onion_address)
+            return False
+
         # Parse the introduction point list, decrypting if necessary
-        introduction_points = parsed_descriptor.introduction_points(
-            authentication_cookie=self.authentication_cookie
-        )
+        if (decoded_introduction_points is not None and
+                decoded_introduction_points.authentication_cookie ==
+                self.authentication_cookie):
+            introduction_points = \
+                decoded_introduction_points.introduction_points
+        else:
+            introduction_points = parsed_descriptor.introduction_points(
+                authentication_cookie=self.authentication_cookie
+            )
+        self.introduction_points_digest = introduction_points_digest
 
         # If the new introduction points are different, flag this instance
         # as modified. Compare the set of introduction point identifiers
@@ -140,6 +179,7 @@ class Instance(object):
         if (set(ip.identifier for ip in introduction_points) !=
                 set(ip.identifier for ip in self.introduction_points)):
             self.changed_since_published = True
+            descriptor.evict_introduction_points(self.introduction_points)
             self.introduction_points = introduction_points
             return True
 
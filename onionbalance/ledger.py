@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""
+Track how individual HSDirs respond to descriptor fetches and uploads
+"""
+import collections
+import threading
+import time
+
+from onionbalance import log
+from onionbalance import config
+
+logger = log.get_logger()
+
+# HS_DESC actions which start a request to an HSDir, and the actions
+# which report its outcome.
+REQUEST_ACTIONS = ('REQUESTED', 'UPLOAD')
+SUCCESS_ACTIONS = ('RECEIVED', 'UPLOADED')
+FAILURE_ACTIONS = ('FAILED',)
+
+HSDirStats = collections.namedtuple('HSDirStats', ['fingerprint', 'successes',
+                                                   'failures', 'latency'])
+
+
+class HSDirRecord(object):
+    """
+    Decayed outcome counts and request latency for a single HSDir
+    """
+
+    def __init__(self, now):
+        self.successes = 0.0
+        self.failures = 0.0
+        self.latency = None
+        self.updated = now
+
+        # Start times of requests which have not completed yet
+        self.pending = collections.deque()
+
+    def decay(self, now, half_life):
+        """
+        Decay the outcome counts for the time since the last update
+        """
+        if now > self.updated and half_life:
+            factor = 0.5 ** ((now - self.updated) / float(half_life))
+            self.successes *= factor
+            self.failures *= factor
+        self.updated = now
+
+    def success_ratio(self):
+        """
+        Estimate the chance a request succeeds, starting from 1/2 for an
+        HSDir without any outcomes
+        """
+        return (self.successes + 1) / (self.successes + self.failures + 2)
+
+
+class HSDirLedger(object):
+    """
+    Ledger of HS_DESC outcomes and request latencies keyed by HSDir
+    fingerprint.
+
+    Outcome counts decay exponentially with a half-life of
+    `config.HSDIR_LEDGER_HALF_LIFE` seconds. The latency is an
+    exponentially weighted moving average of the time between a request
+    and its outcome.
+    """
+
+    # Weight of the newest sample in the latency average
+    LATENCY_WEIGHT = 0.3
+
+    # Give up on matching requests with outcomes after this many seconds
+    PENDING_TIMEOUT = 5 * 60
+
+    # Latency in seconds assumed for every HSDir until one is measured
+    DEFAULT_LATENCY = 1.0
+
+    def __init__(self):
+        self._records = {}
+        self._lock = threading.Lock()
+
+    def _record(self, fingerprint, now):
+        record = self._records.get(fingerprint)
+        if record is None:
+            record = self._records[fingerprint] = HSDirRecord(now)
+        record.decay(now, config.HSDIR_LEDGER_HALF_LIFE)
+        return record
+
+    def record_event(self, action, fingerprint, now=None):
+        """
+        Record a HS_DESC event `action` for the HSDir `fingerprint`
+        """
+        if not fingerprint:
+            return None
+        if now is None:
+            now = time.time()
+        fingerprint = fingerprint.upper()
+
+        with self._lock:
+            record = self._record(fingerprint, now)
+
+            # Drop requests which never received an outcome event
+            while (record.pending and
+                   now - record.pending[0] > self.PENDING_TIMEOUT):
+                record.pending.popleft()
+
+            if action in REQUEST_ACTIONS:
+                record.pending.append(now)
+                return None
+
+            if action in SUCCESS_ACTIONS:
+                record.successes += 1
+            elif action in FAILURE_ACTIONS:
+                record.failures += 1
+            else:
+                return None
+
+            # Tor does not include the descriptor ID in every outcome
+            # event, assume requests to an HSDir complete in order.
+            if record.pending:
+                latency = now - record.pending.popleft()
+                if record.latency is None:
+                    record.latency = latency
+                else:
+                    record.latency += self.LATENCY_WEIGHT * (latency -
+                                                             record.latency)
+
+    def stats(self, now=None):
+        """
+        Return the HSDirStats for every HSDir in the ledger, ordered from
+        the most to the least preferred
+        """
+        if now is None:
+            now = time.time()
+
+        with self._lock:
+            for record in self._records.values():
+                record.decay(now, config.HSDIR_LEDGER_HALF_LIFE)
+            prior_latency = self._prior_latency()
+            return [HSDirStats(fingerprint, record.successes,
+                               record.failures, record.latency)
+                    for fingerprint, record in sorted(
+                        self._records.items(),
+                        key=lambda item: self._sort_key(item[0],
+                                                        prior_latency))]
+
+    def _prior_latency(self):
+        """
+        Latency assumed for HSDirs which have not been measured, the median
+        latency of the measured HSDirs
+        """
+        latencies = sorted(record.latency for record in self._records.values()
+                           if record.latency is not None)
+        if not latencies:
+            return self.DEFAULT_LATENCY
+        return latencies[len(latencies) // 2]
+
+    def _sort_key(self, fingerprint, prior_latency):
+        """
+        Expected time for a successful request to the HSDir. HSDirs without
+        a measured latency are expected to be as fast as the median HSDir,
+        an HSDir without any outcomes has a success ratio of 1/2.
+        """
+        record = self._records.get(fingerprint)
+        if record is None:
+            return prior_latency * 2
+        latency = record.latency
+        if latency is None:
+            latency = prior_latency
+        return latency / record.success_ratio()
+
+    def sort_hsdirs(self, fingerprints):
+        """
+        Order HSDir fingerprints with the fastest responsive HSDirs first
+        """
+        with self._lock:
+            prior_latency = self._prior_latency()
+            return sorted(fingerprints,
+                          key=lambda fingerprint: self._sort_key(
+                              fingerprint.upper(), prior_latency))
+
+    def clear(self):
+        with self._lock:
+            self._records.clear()
+
+
+ledger = HSDirLedger()
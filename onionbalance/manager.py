@@ -21,8 +21,13 @@ from onionbalance import config
 from onionbalance import eventhandler
 from onionbalance import status
 from onionbalance import scheduler
+from onionbalance import consensus
+from onionbalance import descriptor
+from onionbalance import signing
+from onionbalance import ingest
 
 from onionbalance.service import publish_all_descriptors
+from onionbalance.service import upload_to_new_hsdirs
 from onionbalance.instance import fetch_instance_descriptors
 
 logger = log.get_logger()
@@ -71,9 +76,7 @@ def main():
     config_file_options = settings.parse_config_file(args.config)
 
     # Update global configuration with options specified in the config file
-    for setting in dir(config):
-        if setting.isupper() and config_file_options.get(setting):
-            setattr(config, setting, config_file_options.get(setting))
+    settings.apply_config_options(config_file_options)
 
     # Override the log level if specified on the command line.
     if args.verbosity:
@@ -85,6 +88,12 @@ def main():
 
     logger.setLevel(logging.__dict__[config.LOG_LEVEL.upper()])
 
+    # Fork the signing processes before any other threads are started
+    signing.start_pool(config.SIGNING_WORKERS)
+    descriptor.signature_cache.maxsize = config.SIGNATURE_CACHE_SIZE
+    ingest.ingester.start(config.INGEST_WORKERS, config.INGEST_PROCESSES,
+                          config.INGEST_QUEUE_SIZE)
+
     # Create a connection to the Tor unix domain control socket or control port
     try:
         tor_socket = (args.socket or config.TOR_CONTROL_SOCKET)
@@ -135,6 +144,15 @@ def main():
 
     # Finished parsing all the config file.
 
+    # Upload descriptors straight away to HSDirs which become responsible
+    # for them when a new consensus arrives.
+    consensus.refresher.add_callback(upload_to_new_hsdirs)
+
+    # Reuse the HSDir ring from the last run if its consensus is still
+    # valid, and start loading the live consensus in the background.
+    consensus.restore_snapshot()
+    consensus.refresher.request_refresh()
+
     handler = eventhandler.EventHandler()
     controller.add_event_listener(handler.new_status,
                                   EventType.STATUS_GENERAL)
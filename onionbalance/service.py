@@ -1,7 +1,8 @@
 # -*- coding: utf-8 -*-
+import collections
 import datetime
+import itertools
 import time
-import base64
 
 import Crypto.PublicKey.RSA
 import stem
@@ -11,9 +12,16 @@ from onionbalance import util
 from onionbalance import log
 from onionbalance import config
 from onionbalance import consensus
+from onionbalance import signing
+from onionbalance.ledger import ledger
 
 logger = log.get_logger()
 
+# A master descriptor to generate, sign and upload. `hsdirs` lists the
+# `hsdirs` argument of each upload, None lets Tor choose the HSDirs.
+DescriptorPlanItem = collections.namedtuple('DescriptorPlanItem', [
+    'descriptor_id', 'replica', 'deviation', 'hsdirs', 'introduction_points'])
+
 
 def publish_all_descriptors():
     """
@@ -25,9 +33,54 @@ def publish_all_descriptors():
               correlation.
     """
     logger.debug("Checking if any master descriptors should be published.")
+    prefetch_responsible_hsdirs()
     for service in config.services:
         service.descriptor_publish()
 
+    cache_info = consensus.hsdir_cache.info()
+    logger.debug("Responsible HSDir cache for consensus generation %d: "
+                 "%d hits, %d misses, %d descriptor IDs cached.",
+                 cache_info.generation, cache_info.hits, cache_info.misses,
+                 cache_info.currsize)
+
+    cache_info = descriptor.signature_cache.info()
+    logger.debug("Descriptor signature cache: %d hits, %d misses, %d of %d "
+                 "signatures cached.", cache_info.hits, cache_info.misses,
+                 cache_info.currsize, cache_info.maxsize)
+
+
+def upload_to_new_hsdirs(changes=None):
+    """
+    Called when a new consensus is loaded to upload the current
+    descriptors to any HSDirs which are newly responsible for them
+    """
+    for service in config.services:
+        service.upload_to_new_hsdirs()
+
+
+def prefetch_responsible_hsdirs():
+    """
+    Resolve the responsible HSDirs for the descriptor IDs of every service
+    with a single call to `consensus.get_hsdirs_many`.
+
+    The lookups are cached, so the individual lookups made while
+    publishing distinct descriptors will not need to search the HSDir ring.
+    """
+    if not config.DISTINCT_DESCRIPTORS:
+        return None
+
+    descriptor_ids = []
+    for service in config.services:
+        service.refresh_key_material()
+        descriptor_ids.extend(service.descriptor_ids())
+        descriptor_ids.extend(service.next_descriptor_ids())
+
+    try:
+        consensus.get_hsdirs_many(descriptor_ids)
+    except ValueError:
+        logger.debug("Could not prefetch the responsible HSDirs, no "
+                     "consensus is available.")
+
 
 class Service(object):
     """
@@ -52,12 +105,49 @@ class Service(object):
             instances = []
         self.instances = instances
 
-        # Calculate the onion address for this service
-        self.onion_address = util.calc_onion_address(self.service_key)
+        # Derive the public key block, permanent ID and onion address once
+        self.key_material = descriptor.ServiceKeyMaterial.from_key(
+            self.service_key)
+        self.onion_address = self.key_material.onion_address
 
         # Timestamp when this descriptor was last attempted
         self.uploaded = None
 
+        # Map each descriptor ID to its replica and the signed descriptors
+        # last uploaded under it
+        self.published_descriptors = {}
+
+        # Introduction point identifiers assigned to each distinct
+        # descriptor, keyed by descriptor ID and HSDir, and the hour and
+        # introduction point set they were assigned for
+        self._intro_point_assignment = (None, {})
+
+    def descriptor_ids(self, deviation=0):
+        """
+        Calculate the current base32 descriptor ID for each replica
+        """
+        now = time.time()
+        return [util.calc_descriptor_id_b32(self.onion_address, time=now,
+                                            replica=replica,
+                                            deviation=deviation)
+                for replica in range(0, config.REPLICAS)]
+
+    def next_descriptor_ids(self):
+        """
+        Calculate the descriptor IDs the service will move to when its
+        descriptor ID is changing soon, otherwise return no IDs
+        """
+        if not self._descriptor_id_changing_soon():
+            return []
+        return self.descriptor_ids(deviation=1)
+
+    def refresh_key_material(self):
+        """
+        Move the time of the next descriptor ID change forward once the
+        descriptor ID has changed
+        """
+        self.key_material = self.key_material.refreshed()
+
     def _intro_points_modified(self):
         """
         Check if the introduction point set has changed since last
@@ -84,8 +174,7 @@ class Service(object):
         """
         If the descriptor ID will change soon, upload under both descriptor IDs
         """
-        permanent_id = base64.b32decode(self.onion_address, 1)
-        seconds_valid = util.get_seconds_valid(time.time(), permanent_id)
+        seconds_valid = self.key_material.seconds_valid()
 
         # Check if descriptor ID will be changing within the overlap period.
         if seconds_valid < config.DESCRIPTOR_OVERLAP_PERIOD:
@@ -101,6 +190,7 @@ class Service(object):
         choose introduction points.
         """
         available_intro_points = []
+        weights = []
 
         # Loop through each instance and determine fresh intro points
         for instance in self.instances:
@@ -139,12 +229,19 @@ class Service(object):
                 # Include this instance's introduction points
                 instance.changed_since_published = False
                 available_intro_points.append(instance.introduction_points)
+                weights.append(instance.weight)
 
-        return descriptor.IntroductionPointSet(available_intro_points)
+        return descriptor.IntroductionPointSet(available_intro_points,
+                                               weights=weights)
 
-    def _publish_descriptor(self, deviation=0):
+    def plan_descriptors(self, deviations=(0,)):
         """
-        Create, sign and upload master descriptors for this service
+        Plan the master descriptors to publish for this service
+
+        Returns a list of DescriptorPlanItem work items covering every
+        replica under each time period `deviation`. Planning only needs the
+        HSDir list and the instance introduction points, not a Tor
+        controller.
         """
 
         # Retrieve the set of available introduction points
@@ -168,58 +265,155 @@ class Service(object):
                          len(intro_point_set))
             distinct_descriptors = False
 
-        for replica in range(0, config.REPLICAS):
-            # Using distinct descriptors, choose a new set of intro points
-            # for each descriptor and upload it to individual HSDirs.
-            if distinct_descriptors:
+        plan = []
+        now = time.time()
+        for deviation in deviations:
+            for replica in range(0, config.REPLICAS):
                 descriptor_id = util.calc_descriptor_id_b32(
                     self.onion_address,
-                    time=time.time(),
+                    time=now,
                     replica=replica,
                     deviation=deviation,
                 )
-                responsible_hsdirs = consensus.get_hsdirs(descriptor_id)
-
-                for hsdir in responsible_hsdirs:
-                    intro_points = intro_point_set.choose(max_intro_points)
-                    try:
-                        signed_descriptor = (
-                            descriptor.generate_service_descriptor(
-                                self.service_key,
-                                introduction_point_list=intro_points,
-                                replica=replica,
-                                deviation=deviation
-                            ))
-                    except ValueError as exc:
-                        logger.warning("Error generating descriptor: %s", exc)
-                        continue
-
-                    # Signed descriptor was generated successfully, upload it
-                    # to the respective HSDir
-                    self._upload_descriptor(signed_descriptor, replica,
-                                            hsdirs=hsdir)
-                logger.info("Published distinct master descriptors for "
-                            "service %s.onion under replica %d.",
-                            self.onion_address, replica)
 
-            else:
-                # Not using distinct descriptors, upload one descriptor
-                # under each replica and let Tor pick the HSDirs.
-                try:
-                    signed_descriptor = descriptor.generate_service_descriptor(
-                        self.service_key,
-                        introduction_point_list=intro_points,
+                # Using distinct descriptors, upload a descriptor with a
+                # different set of intro points to each individual HSDir.
+                # The intro points are assigned once the whole plan is
+                # known.
+                if distinct_descriptors:
+                    # Include HSDirs which are still queried by clients
+                    # using the previous consensus. Upload to the fastest
+                    # responsive HSDirs first.
+                    responsible_hsdirs = ledger.sort_hsdirs(
+                        consensus.get_hsdirs_with_previous(descriptor_id))
+
+                    for hsdir in responsible_hsdirs:
+                        plan.append(DescriptorPlanItem(
+                            descriptor_id=descriptor_id,
+                            replica=replica,
+                            deviation=deviation,
+                            hsdirs=[hsdir],
+                            introduction_points=None,
+                        ))
+
+                else:
+                    # Not using distinct descriptors, upload one descriptor
+                    # under each replica and let Tor pick the HSDirs. Tor
+                    # picks HSDirs from the current consensus only, also
+                    # upload to any HSDirs only responsible in the previous
+                    # one.
+                    upload_hsdirs = [None]
+                    previous_hsdirs = ledger.sort_hsdirs(
+                        consensus.get_previous_hsdirs(descriptor_id))
+                    if previous_hsdirs:
+                        upload_hsdirs.append(previous_hsdirs)
+
+                    plan.append(DescriptorPlanItem(
+                        descriptor_id=descriptor_id,
                         replica=replica,
-                        deviation=deviation
-                    )
-                except ValueError as exc:
-                    logger.warning("Error generating descriptor: %s", exc)
-                    continue
+                        deviation=deviation,
+                        hsdirs=upload_hsdirs,
+                        introduction_points=intro_points,
+                    ))
 
-                # Signed descriptor was generated successfully, upload it
-                self._upload_descriptor(signed_descriptor, replica)
-                logger.info("Published a descriptor for service %s.onion "
-                            "under replica %d.", self.onion_address, replica)
+        if distinct_descriptors:
+            plan = self._assign_introduction_points(plan, intro_point_set,
+                                                    max_intro_points)
+
+        return plan
+
+    def _assign_introduction_points(self, plan, intro_point_set, count):
+        """
+        Assign up to `count` introduction points to each distinct
+        descriptor in `plan`
+
+        The intro points of all distinct descriptors are planned together
+        so every available intro point is exposed and each instance is
+        spread evenly across the HSDirs. While the publication hour and the
+        available introduction points are unchanged the previous assignment
+        is reused, so republished descriptors are identical and their
+        cached signatures are reused.
+        """
+        key = (util.rounded_timestamp(), count,
+               intro_point_set.selection_key())
+        previous_key, previous_assignment = self._intro_point_assignment
+        if key == previous_key and all(
+                (item.descriptor_id, item.hsdirs[0]) in previous_assignment
+                for item in plan):
+            intro_points = dict(
+                (intro_point.identifier, intro_point)
+                for intro_point in itertools.chain.from_iterable(
+                    intro_point_set.available_intro_points))
+            return [item._replace(introduction_points=[
+                intro_points[identifier] for identifier in
+                previous_assignment[(item.descriptor_id, item.hsdirs[0])]])
+                for item in plan]
+
+        assignment = intro_point_set.assign(len(plan), count)
+        plan = [item._replace(introduction_points=intro_points)
+                for item, intro_points in zip(plan, assignment)]
+        self._intro_point_assignment = (key, dict(
+            ((item.descriptor_id, item.hsdirs[0]),
+             [intro_point.identifier
+              for intro_point in item.introduction_points])
+            for item in plan))
+        return plan
+
+    def generate_descriptors(self, plan):
+        """
+        Generate the unsigned descriptor for each DescriptorPlanItem
+
+        Returns a list of (DescriptorPlanItem, unsigned descriptor) pairs.
+        Items for which no descriptor could be generated are left out.
+        """
+        descriptors = []
+        for item in plan:
+            try:
+                unsigned_descriptor = (
+                    descriptor.generate_unsigned_service_descriptor(
+                        self.key_material,
+                        introduction_point_list=item.introduction_points,
+                        replica=item.replica,
+                        deviation=item.deviation
+                    ))
+            except ValueError as exc:
+                logger.warning("Error generating descriptor: %s", exc)
+                continue
+            descriptors.append((item, unsigned_descriptor))
+        return descriptors
+
+    def sign_descriptors(self, descriptors):
+        """
+        Sign the generated descriptors as one batch
+
+        Returns a list of (DescriptorPlanItem, signed descriptor) pairs.
+        """
+        signed_descriptors = signing.sign_descriptors(
+            [unsigned_descriptor for _, unsigned_descriptor in descriptors],
+            self.service_key)
+        return [(item, signed_descriptor) for (item, _), signed_descriptor
+                in zip(descriptors, signed_descriptors)]
+
+    def upload_descriptors(self, signed_descriptors):
+        """
+        Upload each signed descriptor to the HSDirs planned for it
+        """
+        published_descriptors = {}
+        for item, signed_descriptor in signed_descriptors:
+            for hsdirs in item.hsdirs:
+                self._upload_descriptor(signed_descriptor, item.replica,
+                                        hsdirs=hsdirs)
+            published_descriptors.setdefault(
+                item.descriptor_id,
+                (item.replica, []))[1].append(signed_descriptor)
+
+        for descriptor_id, (replica, descriptors) in sorted(
+                published_descriptors.items(), key=lambda item: item[1][0]):
+            logger.info("Published %d master descriptors for service "
+                        "%s.onion under replica %d.", len(descriptors),
+                        self.onion_address, replica)
+
+        self._record_published_descriptors(published_descriptors)
 
         # It would be better to set last_uploaded when an upload succeeds and
         # not when an upload is just attempted. Unfortunately the HS_DESC #
@@ -227,6 +421,59 @@ class Service(object):
         # so it can't be used to determine when descriptor upload succeeds
         self.uploaded = datetime.datetime.utcnow()
 
+    def _publish_descriptors(self, deviations=(0,)):
+        """
+        Create, sign and upload master descriptors for this service
+        """
+        plan = self.plan_descriptors(deviations)
+        descriptors = self.generate_descriptors(plan)
+        self.upload_descriptors(self.sign_descriptors(descriptors))
+
+    def _record_published_descriptors(self, published_descriptors):
+        """
+        Remember the descriptors uploaded under each current descriptor ID
+
+        Descriptors for descriptor IDs which are no longer current are
+        dropped. The mapping is replaced rather than modified in place as
+        it is read from the consensus refresh thread.
+        """
+        current_descriptor_ids = set(self.descriptor_ids() +
+                                     self.descriptor_ids(deviation=1))
+        descriptors = dict(
+            (descriptor_id, uploads) for descriptor_id, uploads
+            in self.published_descriptors.items()
+            if descriptor_id in current_descriptor_ids)
+        descriptors.update(published_descriptors)
+        self.published_descriptors = descriptors
+
+    def upload_to_new_hsdirs(self):
+        """
+        Upload the published descriptors to HSDirs which became responsible
+        for their descriptor IDs in the latest consensus
+
+        The descriptors already published under each descriptor ID are
+        uploaded as they are, without generating or signing new
+        descriptors.
+        """
+        for descriptor_id, (replica, signed_descriptors) in list(
+                self.published_descriptors.items()):
+            try:
+                new_hsdirs = ledger.sort_hsdirs(
+                    consensus.get_new_hsdirs(descriptor_id))
+            except ValueError:
+                return None
+
+            for index, hsdir in enumerate(new_hsdirs):
+                signed_descriptor = signed_descriptors[
+                    index % len(signed_descriptors)]
+                self._upload_descriptor(signed_descriptor, replica,
+                                        hsdirs=hsdir)
+
+            if new_hsdirs:
+                logger.info("Uploaded descriptors for service %s.onion to "
+                            "%d newly responsible HSDirs under replica %d.",
+                            self.onion_address, len(new_hsdirs), replica)
+
     def _upload_descriptor(self, signed_descriptor, replica, hsdirs=None):
         """
         Convenience method to upload a descriptor
@@ -255,6 +502,7 @@ class Service(object):
         """
         Publish descriptor if have new IPs or if descriptor has expired
         """
+        self.refresh_key_material()
 
         # A descriptor should be published if any of the following conditions
         # are True
@@ -264,14 +512,16 @@ class Service(object):
 
             logger.debug("Publishing a descriptor for service %s.onion.",
                          self.onion_address)
-            self._publish_descriptor()
+            deviations = [0]
 
             # If the descriptor ID will change soon, need to upload under
             # the new ID too.
             if self._descriptor_id_changing_soon():
                 logger.info("Publishing a descriptor for service %s.onion "
                             "under next descriptor ID.", self.onion_address)
-                self._publish_descriptor(deviation=1)
+                deviations.append(1)
+
+            self._publish_descriptors(deviations)
 
         else:
             logger.debug("Not publishing a new descriptor for service "
@@ -50,6 +50,19 @@ def parse_config_file(config_file):
     return config_data
 
 
+def apply_config_options(config_file_options):
+    """
+    Update the global configuration with the options set in the config file
+
+    Options set to false, 0 or an empty string are applied. Options which
+    are missing or left without a value keep their default.
+    """
+    for setting in dir(config):
+        if (setting.isupper() and
+                config_file_options.get(setting) is not None):
+            setattr(config, setting, config_file_options.get(setting))
+
+
 def initialize_services(controller, services_config):
     """
     Load keys for services listed in the config
@@ -93,10 +106,18 @@ def initialize_services(controller, services_config):
         else:
             instances = []
             for instance in instance_config:
+                weight = instance.get("weight", 1)
+                if (not isinstance(weight, (int, float)) or
+                        isinstance(weight, bool) or weight <= 0):
+                    logger.error("The weight of instance %s must be a "
+                                 "positive number.", instance.get("address"))
+                    sys.exit(1)
+
                 instances.append(onionbalance.instance.Instance(
                     controller=controller,
                     onion_address=instance.get("address"),
-                    authentication_cookie=instance.get("auth")
+                    authentication_cookie=instance.get("auth"),
+                    weight=weight
                 ))
 
             logger.info("Loaded %d instances for service %s.onion.",
@@ -112,6 +133,20 @@ def initialize_services(controller, services_config):
         # Store a global reference to current controller connection
         config.controller = controller
 
+    index_instances()
+
+
+def index_instances():
+    """
+    Rebuild the index of configured instances by onion address
+    """
+    instances_by_address = {}
+    for service in config.services:
+        for instance in service.instances:
+            instances_by_address.setdefault(instance.onion_address,
+                                            []).append(instance)
+    config.instances_by_address = instances_by_address
+
 
 def parse_cmd_args():
     """
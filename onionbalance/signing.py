@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+Sign batches of descriptors, optionally in a pool of worker processes
+"""
+import hashlib
+import multiprocessing
+import signal
+
+import Crypto.PublicKey.RSA
+
+from onionbalance import log
+from onionbalance import descriptor
+
+logger = log.get_logger()
+
+# Pool of signing worker processes, None when signing in-process
+pool = None
+
+# Service keys reconstructed in a worker process keyed by their modulus
+_worker_keys = {}
+
+
+def _init_worker():
+    """
+    Leave handling SIGINT to the management server process
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _key_components(key):
+    return (key.n, key.e, key.d, key.p, key.q, key.u)
+
+
+def _sign_in_worker(task):
+    """
+    Sign a descriptor digest in a worker process
+    """
+    key_components, digest = task
+    key = _worker_keys.get(key_components[0])
+    if key is None:
+        key = Crypto.PublicKey.RSA.construct(key_components)
+        _worker_keys[key_components[0]] = key
+    return descriptor.make_signature_block(digest, key)
+
+
+def start_pool(workers):
+    """
+    Start `workers` signing processes. No pool is started when `workers`
+    is 0 and descriptors are signed in-process.
+
+    The pool should be started before any other threads are running as
+    the worker processes are forked.
+    """
+    global pool
+    if not workers or pool is not None:
+        return None
+
+    try:
+        pool = multiprocessing.Pool(workers, initializer=_init_worker)
+    except (OSError, ValueError) as exc:
+        logger.warning("Could not start the signing pool, descriptors will "
+                       "be signed in-process: %s", exc)
+    else:
+        logger.debug("Started %d descriptor signing processes.", workers)
+
+
+def stop_pool():
+    global pool
+    if pool is not None:
+        pool.terminate()
+        pool = None
+
+
+def sign_descriptors(unsigned_descriptors, service_key):
+    """
+    Sign a list of descriptors with `service_key`
+
+    The descriptors are UnsignedDescriptor tuples, for which the signed
+    descriptors are returned as bytes, or descriptor strings for which str
+    is returned. The signatures are produced by the signing pool when it is
+    running and are identical to `descriptor.sign_descriptor`. Returns the
+    list of signed descriptors in the same order.
+    """
+    documents = []
+    digests = []
+    for unsigned_descriptor in unsigned_descriptors:
+        if isinstance(unsigned_descriptor, descriptor.UnsignedDescriptor):
+            documents.append(unsigned_descriptor.body)
+            digests.append(unsigned_descriptor.digest)
+        else:
+            document = descriptor.strip_signature(unsigned_descriptor)
+            documents.append(document)
+            digests.append(hashlib.sha1(document.encode('utf-8')).digest())
+
+    # Only sign the descriptors which have not been signed before
+    signature_cache = descriptor.signature_cache
+    signatures = [signature_cache.get(digest) for digest in digests]
+    unsigned_digests = [digest for digest, signature
+                        in zip(digests, signatures) if signature is None]
+
+    new_signatures = None
+    if pool is not None and len(unsigned_digests) > 1:
+        key_components = _key_components(service_key)
+        try:
+            new_signatures = pool.map(_sign_in_worker,
+                                      [(key_components, digest)
+                                       for digest in unsigned_digests])
+        except Exception:
+            logger.exception("Signing pool failed, signing the descriptors "
+                             "in-process.")
+
+    if new_signatures is None:
+        new_signatures = [descriptor.make_signature_block(digest, service_key)
+                          for digest in unsigned_digests]
+
+    new_signatures = iter(new_signatures)
+    for index, digest in enumerate(digests):
+        if signatures[index] is None:
+            signatures[index] = next(new_signatures)
+            signature_cache.set(digest, signatures[index])
+
+    signed_descriptors = []
+    for document, signature in zip(documents, signatures):
+        if isinstance(document, bytes):
+            signed_descriptors.append(document + signature)
+        else:
+            signed_descriptors.append(document + signature.decode('utf-8'))
+    return signed_descriptors
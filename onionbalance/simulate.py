@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+
+"""
+Simulate descriptor placement and publishing load without a Tor network.
+
+The HSDir ring is read from a cached consensus file and the descriptor
+IDs for each master service are calculated over a number of simulated
+days, following the same publishing schedule as the management server.
+"""
+from __future__ import division, print_function
+import argparse
+import base64
+import calendar
+import collections
+import datetime
+import logging
+import random
+import sys
+import time
+
+import onionbalance
+from onionbalance import config
+from onionbalance import consensus
+from onionbalance import log
+from onionbalance import settings
+from onionbalance import util
+
+logger = log.get_logger()
+
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+SimulationResult = collections.namedtuple('SimulationResult', [
+    'fan_in', 'services_per_hsdir', 'signatures_per_day', 'bursts'])
+
+# Descriptors uploaded by one publishing check of the management server
+Burst = collections.namedtuple('Burst', ['time', 'uploads', 'rotating'])
+
+
+def synthetic_onion_addresses(count, seed=None):
+    """
+    Generate onion addresses for `count` random master services
+    """
+    rng = random.Random(seed)
+    return [base64.b32encode(bytearray(rng.getrandbits(8)
+                                       for _ in range(10))).decode('utf-8')
+            .lower() for _ in range(count)]
+
+
+def load_onion_addresses(config_file):
+    """
+    Load the master service keys listed in an OnionBalance config file
+
+    Options set in the config file override the defaults in `config`,
+    as they do for the management server.
+    """
+    config_file_options = settings.parse_config_file(config_file)
+    settings.apply_config_options(config_file_options)
+
+    onion_addresses = []
+    for service in config_file_options.get('services'):
+        service_key = util.key_decrypt_prompt(service.get('key'))
+        if not service_key:
+            logger.error("Private key %s could not be loaded.",
+                         service.get('key'))
+            sys.exit(1)
+        onion_addresses.append(util.calc_onion_address(service_key))
+    return onion_addresses
+
+
+def _rotating_soon(permanent_id, now):
+    return (util.get_seconds_valid(now, permanent_id) <
+            config.DESCRIPTOR_OVERLAP_PERIOD)
+
+
+def simulate(onion_addresses, start, days, distinct_descriptors=None):
+    """
+    Simulate publishing descriptors for each master service for `days`
+    days from the timestamp `start`.
+
+    A publishing check runs every `config.PUBLISH_CHECK_INTERVAL` seconds.
+    Each service publishes once `config.DESCRIPTOR_UPLOAD_PERIOD` has passed
+    since its last upload, also under the next descriptor ID when its
+    descriptor ID changes within `config.DESCRIPTOR_OVERLAP_PERIOD`. The
+    instances are assumed to provide enough introduction points to use
+    distinct descriptors when they are enabled.
+    """
+    if distinct_descriptors is None:
+        distinct_descriptors = config.DISTINCT_DESCRIPTORS
+
+    permanent_ids = [base64.b32decode(onion_address, 1)
+                     for onion_address in onion_addresses]
+    uploaded = [None] * len(onion_addresses)
+
+    fan_in = collections.Counter()
+    services_per_hsdir = collections.defaultdict(set)
+    signatures_per_day = collections.OrderedDict()
+    bursts = []
+
+    now = start + config.INITIAL_DELAY
+    end = start + days * 24 * 60 * 60
+    while now < end:
+        day = datetime.datetime.utcfromtimestamp(now).strftime("%Y-%m-%d")
+        signatures = signatures_per_day.setdefault(day, 0)
+        uploads = 0
+        rotating = 0
+
+        for index, onion_address in enumerate(onion_addresses):
+            if (uploaded[index] is not None and now - uploaded[index] <=
+                    config.DESCRIPTOR_UPLOAD_PERIOD):
+                continue
+            uploaded[index] = now
+
+            deviations = [0]
+            if _rotating_soon(permanent_ids[index], now):
+                deviations.append(1)
+                rotating += 1
+
+            for deviation in deviations:
+                for replica in range(0, config.REPLICAS):
+                    descriptor_id = util.calc_descriptor_id_b32(
+                        onion_address, time=now, replica=replica,
+                        deviation=deviation)
+                    hsdirs = consensus.get_hsdirs(descriptor_id)
+                    for hsdir in hsdirs:
+                        fan_in[hsdir] += 1
+                        services_per_hsdir[hsdir].add(onion_address)
+                    uploads += len(hsdirs)
+
+                    # A distinct descriptor is signed for each HSDir
+                    signatures += len(hsdirs) if distinct_descriptors else 1
+
+        signatures_per_day[day] = signatures
+        if uploads:
+            bursts.append(Burst(now, uploads, rotating))
+        now += config.PUBLISH_CHECK_INTERVAL
+
+    services_per_hsdir = dict((hsdir, len(services)) for hsdir, services
+                              in services_per_hsdir.items())
+    return SimulationResult(fan_in, services_per_hsdir, signatures_per_day,
+                            bursts)
+
+
+def format_report(result, num_services, top=10):
+    """
+    Summarise a SimulationResult as a list of lines
+    """
+    lines = []
+    num_hsdirs = len(consensus.HSDIR_LIST)
+    lines.append("Simulated {} services on {} HSDirs.".format(
+        num_services, num_hsdirs))
+
+    uploads = sum(result.fan_in.values())
+    lines.append("")
+    lines.append("Upload fan-in: {} uploads to {} HSDirs, {:.1f} per HSDir "
+                 "on average.".format(uploads, len(result.fan_in),
+                                      uploads / max(num_hsdirs, 1)))
+    for hsdir, count in result.fan_in.most_common(top):
+        lines.append("  ${} {} uploads {} services".format(
+            hsdir, count, result.services_per_hsdir[hsdir]))
+
+    lines.append("")
+    lines.append("Signed descriptors per day:")
+    for day, signatures in result.signatures_per_day.items():
+        lines.append("  {} {}".format(day, signatures))
+
+    lines.append("")
+    lines.append("Peak HSPOST bursts:")
+    peaks = sorted(result.bursts, key=lambda burst: burst.uploads,
+                   reverse=True)[:top]
+    for burst in sorted(peaks, key=lambda burst: burst.time):
+        lines.append("  {} {} uploads {} services rotating".format(
+            datetime.datetime.utcfromtimestamp(burst.time).strftime(
+                TIME_FORMAT), burst.uploads, burst.rotating))
+    return lines
+
+
+def parse_cmd_args():
+    """
+    Parses and returns command line arguments.
+    """
+
+    parser = argparse.ArgumentParser(
+        description="onionbalance-simulate estimates the descriptor "
+        "publishing load of an OnionBalance management server from a cached "
+        "Tor consensus, without connecting to the Tor network.")
+
+    parser.add_argument("--consensus", type=str, required=True,
+                        help="Cached consensus file from a Tor "
+                        "DataDirectory.")
+
+    services = parser.add_mutually_exclusive_group(required=True)
+    services.add_argument("-c", "--config", type=str,
+                          help="OnionBalance config file listing the master "
+                          "services.")
+
+    services.add_argument("-n", type=int, dest="num_services",
+                          help="Simulate this many random master services.")
+
+    parser.add_argument("--seed", type=int, default=None,
+                        help="Seed for the random master services.")
+
+    parser.add_argument("--days", type=float, default=1,
+                        help="Number of days to simulate (default: "
+                        "%(default)s).")
+
+    parser.add_argument("--start", type=str, default=None,
+                        help="Start of the simulation as 'YYYY-MM-DD "
+                        "HH:MM:SS' in UTC (default: consensus valid-after "
+                        "time).")
+
+    parser.add_argument("--top", type=int, default=10,
+                        help="Number of HSDirs and bursts to list "
+                        "(default: %(default)s).")
+
+    parser.add_argument('--version', action='version',
+                        version='onionbalance %s' % onionbalance.__version__)
+
+    return parser
+
+
+def main():
+    """
+    Entry point when invoked over the command line.
+    """
+    args = parse_cmd_args().parse_args()
+    logger.setLevel(logging.WARNING)
+
+    if args.config:
+        onion_addresses = load_onion_addresses(args.config)
+    else:
+        onion_addresses = synthetic_onion_addresses(args.num_services,
+                                                    seed=args.seed)
+
+    try:
+        hsdir_ring = consensus.load_hsdir_ring(args.consensus)
+    except (IOError, OSError, ValueError) as exc:
+        logger.error("Could not load the consensus %s: %s", args.consensus,
+                     exc)
+        sys.exit(1)
+    consensus.update_hsdir_list(hsdir_ring, hsdir_ring.valid_after,
+                                hsdir_ring.valid_until)
+    if not consensus.HSDIR_LIST:
+        logger.error("No HSDirs found in the consensus %s.", args.consensus)
+        sys.exit(1)
+
+    if args.start:
+        start = calendar.timegm(time.strptime(args.start, TIME_FORMAT))
+    elif hsdir_ring.valid_after:
+        start = hsdir_ring.valid_after
+    else:
+        start = int(time.time())
+
+    result = simulate(onion_addresses, start, args.days)
+    print('\n'.join(format_report(result, len(onion_addresses),
+                                  top=args.top)))
@@ -11,9 +11,14 @@ from socketserver import BaseRequestHandler, ThreadingMixIn, UnixStreamServer
 
 from onionbalance import log
 from onionbalance import config
+from onionbalance.ingest import ingester
+from onionbalance.ledger import ledger
 
 logger = log.get_logger()
 
+# Number of the most and of the least preferred HSDirs listed in the status
+STATUS_HSDIRS = 5
+
 
 class StatusSocketHandler(BaseRequestHandler):
     """
@@ -42,6 +47,34 @@ class StatusSocketHandler(BaseRequestHandler):
                         instance.onion_address,
                         instance.timestamp.strftime(time_format),
                         len(instance.introduction_points)))
+
+        hsdir_stats = ledger.stats()
+        if hsdir_stats:
+            response.append("HSDirs {} tracked".format(len(hsdir_stats)))
+
+        # Only list the most and least preferred HSDirs
+        if len(hsdir_stats) > 2 * STATUS_HSDIRS:
+            hsdir_stats = (hsdir_stats[:STATUS_HSDIRS] + [None] +
+                           hsdir_stats[-STATUS_HSDIRS:])
+        for hsdir in hsdir_stats:
+            if hsdir is None:
+                response.append("  ...")
+                continue
+            if hsdir.latency is None:
+                latency = "[no latency]"
+            else:
+                latency = "{:.2f}s".format(hsdir.latency)
+            response.append("  ${} {:.1f} ok {:.1f} failed {}".format(
+                hsdir.fingerprint, hsdir.successes, hsdir.failures, latency))
+
+        ingest_stats = ingester.queue.stats()
+        if ingest_stats.received:
+            response.append("Descriptor queue")
+            response.append("  {} queued {} processed {} replaced {} "
+                            "dropped {:.2f}s latency".format(
+                                ingest_stats.depth, ingest_stats.processed,
+                                ingest_stats.replaced, ingest_stats.dropped,
+                                ingest_stats.latency or 0.0))
         response.append("")
         self.request.sendall('\n'.join(response).encode('utf-8'))
 
@@ -69,6 +102,10 @@ class StatusSocket(object):
             uweyln7jhkyaokka.onion 2016-05-01 11:08:56
               r523s7jx65ckitf4.onion [offline]
               v2q7ujuleky7odph.onion 2016-05-01 11:00:00 3 IPs
+            HSDirs 1 tracked
+              $1B5E0C96E0B6CF1E44DB8E5A3A19C4F0D4ABE5A1 4.2 ok 0.0 failed 0.81s
+            Descriptor queue
+              0 queued 12 processed 0 replaced 0 dropped 0.04s latency
         """
         self.unix_socket_filename = status_socket_location
         self.cleanup_socket_file()
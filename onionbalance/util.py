@@ -8,9 +8,13 @@ import binascii
 import os
 import stem
 import time
+import collections
+import threading
 
 # import Crypto.Util
 import Crypto.PublicKey
+import Crypto.Util.asn1
+import Crypto.Util.number
 
 from onionbalance import config
 
@@ -27,16 +31,12 @@ def add_pkcs1_padding(message):
 
 
 def get_asn1_sequence(rsa_key):
-    seq = Crypto.Util.asn1.DerSequence()
-    seq.append(rsa_key.n)
-    seq.append(rsa_key.e)
-    asn1_seq = seq.encode()
-    return asn1_seq
+    return get_crypto_backend().public_key_der(rsa_key)
 
 
 def calc_key_digest(rsa_key):
     """Calculate the SHA1 digest of an RSA key"""
-    return hashlib.sha1(get_asn1_sequence(rsa_key)).digest()
+    return get_crypto_backend().key_digest(rsa_key)
 
 
 def calc_permanent_id(rsa_key):
@@ -175,3 +175,128 @@ def reauthenticate(controller, logger):
         controller.authenticate(password=config.TOR_CONTROL_PASSWORD)
     except stem.connection.AuthenticationFailure:
         logger.error("Failed to re-authenticate controller.")
+
+
+CacheInfo = collections.namedtuple('CacheInfo', ['hits', 'misses', 'maxsize',
+                                                 'currsize'])
+
+
+class LRUCache(object):
+    """
+    Bounded mapping which evicts the least recently used entries
+
+    Lookups and insertions are thread-safe. The number of hits and misses
+    is counted and reported by `info()`.
+    """
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """
+        Return the cached value for `key` and mark it as recently used
+        """
+        with self._lock:
+            try:
+                value = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._entries[key] = value
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        """
+        Cache `value` under `key`, evicting the least recently used entries
+        beyond `maxsize`. Nothing is cached when `maxsize` is 0.
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+            if self.maxsize <= 0:
+                return None
+            self._entries[key] = value
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._entries.pop(key, default)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def info(self):
+        return CacheInfo(hits=self.hits, misses=self.misses,
+                         maxsize=self.maxsize, currsize=len(self._entries))
+
+
+def check_signature(rsa_key, signature_long, padded_digest):
+    """
+    Check an RSA signature against the padded digest it signs
+
+    PyCrypto signs using the Chinese Remainder Theorem. A fault in either
+    half of the computation produces a signature which reveals the factors
+    of the key, it must never be published.
+    """
+    if (pow(signature_long, rsa_key.e, rsa_key.n) !=
+            Crypto.Util.number.bytes_to_long(padded_digest)):
+        raise ValueError("The RSA signature does not verify, refusing to "
+                         "use it.")
+
+
+class PyCryptoBackend(object):
+    """
+    Crypto backend which uses PyCrypto for every operation
+    """
+    name = 'pycrypto'
+
+    def sign(self, private_key, digest):
+        """
+        Sign a message digest with PKCS#1 padding, returning the 128 byte
+        signature
+        """
+        padded_digest = add_pkcs1_padding(digest)
+        (signature_long, ) = private_key.sign(padded_digest, None)
+        check_signature(private_key, signature_long, padded_digest)
+        return Crypto.Util.number.long_to_bytes(signature_long, 128)
+
+    def public_key_der(self, rsa_key):
+        """
+        DER encode the public modulus and exponent of an RSA key
+        """
+        seq = Crypto.Util.asn1.DerSequence()
+        seq.append(rsa_key.n)
+        seq.append(rsa_key.e)
+        return seq.encode()
+
+    def key_digest(self, rsa_key):
+        return hashlib.sha1(self.public_key_der(rsa_key)).digest()
+
+
+CRYPTO_BACKENDS = dict((backend.name, backend) for backend in
+                       [PyCryptoBackend()])
+
+
+def get_crypto_backend(name='pycrypto'):
+    """
+    Return the crypto backend `name`
+    """
+    try:
+        return CRYPTO_BACKENDS[name]
+    except KeyError:
+        raise ValueError("Unknown crypto backend '%s', choose one of: %s" %
+                         (name, ', '.join(sorted(CRYPTO_BACKENDS))))
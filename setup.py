@@ -28,6 +28,7 @@ setup(
         "console_scripts": [
             'onionbalance = onionbalance.manager:main',
             'onionbalance-config = onionbalance.settings:generate_config',
+            'onionbalance-simulate = onionbalance.simulate:main',
         ]},
     description="OnionBalance provides load-balancing and redundancy for Tor "
                 "hidden services by distributing requests to multiple backend "
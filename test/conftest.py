@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from onionbalance import consensus
+
+
+@pytest.fixture(autouse=True)
+def consensus_state(monkeypatch):
+    """
+    Start each test with empty HSDir rings and caches, so consensus updates
+    made by a test do not leak into other tests
+    """
+    monkeypatch.setattr(consensus, 'HSDIR_LIST', consensus.HSDirRing())
+    monkeypatch.setattr(consensus, 'PREVIOUS_HSDIR_LIST',
+                        consensus.HSDirRing())
+    monkeypatch.setattr(consensus, 'HSDIR_LIST_UPDATED', None)
+    monkeypatch.setattr(consensus, 'HSDIR_CHANGES', consensus.HSDirChanges(
+        joined=frozenset(), left=frozenset()))
+    monkeypatch.setattr(consensus, 'CONSENSUS_GENERATION', 0)
+    monkeypatch.setattr(consensus, 'hsdir_cache',
+                        consensus.ResponsibleHSDirCache())
@@ -1,4 +1,6 @@
 # -*- coding: utf-8 -*-
+import threading
+
 import pytest
 
 from onionbalance import consensus
@@ -30,7 +32,8 @@ def test_get_hsdirs_no_consensus():
 def test_get_hsdirs(monkeypatch):
     """Test for normal responsible HSDir selection"""
 
-    monkeypatch.setattr(consensus, 'HSDIR_LIST', MOCK_HSDIR_LIST)
+    monkeypatch.setattr(consensus, 'HSDIR_LIST',
+                        consensus.HSDirRing(MOCK_HSDIR_LIST))
 
     # Descriptor ID before '222....''
     descriptor_id_base32 = "eiqaaaaaaaaaaaaaaaaaaaaaaaaaaaaa"
@@ -46,7 +49,8 @@ def test_get_hsdirs(monkeypatch):
 def test_get_hsdirs_edge_of_ring(monkeypatch):
     """Test that selection wraps around the edge of the HSDir ring"""
 
-    monkeypatch.setattr(consensus, 'HSDIR_LIST', MOCK_HSDIR_LIST)
+    monkeypatch.setattr(consensus, 'HSDIR_LIST',
+                        consensus.HSDirRing(MOCK_HSDIR_LIST))
 
     # Descriptor ID before '666....''
     descriptor_id_base32 = "mzqaaaaaaaaaaaaaaaaaaaaaaaaaaaaa"
@@ -66,7 +70,8 @@ def test_get_hsdirs_no_repeat(monkeypatch):
         "1111111111111111111111111111111111111111",
         "2222222222222222222222222222222222222222",
     ]
-    monkeypatch.setattr(consensus, 'HSDIR_LIST', SHORT_HSDIR_LIST)
+    monkeypatch.setattr(consensus, 'HSDIR_LIST',
+                        consensus.HSDirRing(SHORT_HSDIR_LIST))
 
     # Descriptor ID before '111....''
     descriptor_id_base32 = "ceiaaaaaaaaaaaaaaaaaaaaaaaaaaaaa"
@@ -76,3 +81,315 @@ def test_get_hsdirs_no_repeat(monkeypatch):
         "1111111111111111111111111111111111111111",
         "2222222222222222222222222222222222222222",
     ])
+
+
+def test_update_hsdir_list(monkeypatch):
+    """Test that only the HSDirs which joined or left are applied"""
+
+    monkeypatch.setattr(consensus, 'HSDIR_LIST',
+                        consensus.HSDirRing(MOCK_HSDIR_LIST))
+
+    new_hsdirs = set(MOCK_HSDIR_LIST)
+    new_hsdirs.remove("3333333333333333333333333333333333333333")
+    new_hsdirs.add("0000000000000000000000000000000000000000")
+    new_hsdirs.add("4545454545454545454545454545454545454545")
+
+    changes = consensus.update_hsdir_list(new_hsdirs)
+
+    assert changes.joined == set([
+        "0000000000000000000000000000000000000000",
+        "4545454545454545454545454545454545454545",
+    ])
+    assert changes.left == set(["3333333333333333333333333333333333333333"])
+    assert list(consensus.HSDIR_LIST) == sorted(new_hsdirs)
+
+
+def test_update_hsdir_list_unchanged(monkeypatch):
+    """Test that no changes are reported when the HSDir set is the same"""
+
+    monkeypatch.setattr(consensus, 'HSDIR_LIST',
+                        consensus.HSDirRing(MOCK_HSDIR_LIST))
+
+    changes = consensus.update_hsdir_list(MOCK_HSDIR_LIST)
+    assert not changes.joined
+    assert not changes.left
+    assert list(consensus.HSDIR_LIST) == MOCK_HSDIR_LIST
+
+
+def test_get_hsdirs_cached(monkeypatch):
+    """Test that lookups are cached until a new consensus is loaded"""
+
+    monkeypatch.setattr(consensus, 'HSDIR_LIST',
+                        consensus.HSDirRing(MOCK_HSDIR_LIST))
+
+    descriptor_id_base32 = "eiqaaaaaaaaaaaaaaaaaaaaaaaaaaaaa"
+    first_lookup = consensus.get_hsdirs(descriptor_id_base32)
+    assert consensus.get_hsdirs(descriptor_id_base32) == first_lookup
+
+    cache_info = consensus.hsdir_cache.info()
+    assert (cache_info.hits, cache_info.misses) == (1, 1)
+
+    # Loading a new HSDir list should drop the cached lookups
+    new_hsdirs = list(MOCK_HSDIR_LIST)
+    new_hsdirs.remove("3333333333333333333333333333333333333333")
+    consensus.update_hsdir_list(new_hsdirs)
+
+    assert consensus.get_hsdirs(descriptor_id_base32) == [
+        "2222222222222222222222222222222222222222",
+        "4444444444444444444444444444444444444444",
+        "5555555555555555555555555555555555555555",
+    ]
+    cache_info = consensus.hsdir_cache.info()
+    assert (cache_info.hits, cache_info.misses) == (1, 2)
+    assert cache_info.currsize == 1
+
+
+def test_get_hsdirs_cached_ring_swapped(monkeypatch):
+    """
+    Test that a lookup made while the ring is swapped is not cached for
+    the new ring
+    """
+    monkeypatch.setattr(consensus, 'HSDIR_LIST',
+                        consensus.HSDirRing(MOCK_HSDIR_LIST))
+
+    new_hsdirs = list(MOCK_HSDIR_LIST)
+    new_hsdirs.remove("3333333333333333333333333333333333333333")
+    old_ring = consensus.HSDIR_LIST
+    responsible = old_ring.responsible
+
+    def swap_during_lookup(digest, count):
+        consensus.update_hsdir_list(new_hsdirs)
+        return responsible(digest, count)
+    monkeypatch.setattr(old_ring, 'responsible', swap_during_lookup)
+
+    descriptor_id_base32 = "eiqaaaaaaaaaaaaaaaaaaaaaaaaaaaaa"
+    assert "3333333333333333333333333333333333333333" in (
+        consensus.get_hsdirs(descriptor_id_base32))
+    assert consensus.get_hsdirs(descriptor_id_base32) == [
+        "2222222222222222222222222222222222222222",
+        "4444444444444444444444444444444444444444",
+        "5555555555555555555555555555555555555555",
+    ]
+
+
+def test_hsdir_ring():
+    """Test the packed HSDir ring behaves like a sorted fingerprint list"""
+
+    ring = consensus.HSDirRing(reversed(MOCK_HSDIR_LIST))
+    assert len(ring) == 6
+    assert list(ring) == MOCK_HSDIR_LIST
+    assert ring[-1] == "6666666666666666666666666666666666666666"
+    assert len(ring.buffer) == 6 * consensus.FINGERPRINT_LEN
+    assert "3333333333333333333333333333333333333333" in ring
+    assert "3333333333333333333333333333333333333334" not in ring
+
+    with pytest.raises(IndexError):
+        ring[6]
+
+
+def test_get_hsdirs_many(monkeypatch):
+    """Test resolving many descriptor IDs in one lookup"""
+
+    monkeypatch.setattr(consensus, 'HSDIR_LIST',
+                        consensus.HSDirRing(MOCK_HSDIR_LIST))
+
+    descriptor_ids = [
+        "mzqaaaaaaaaaaaaaaaaaaaaaaaaaaaaa",
+        "eiqaaaaaaaaaaaaaaaaaaaaaaaaaaaaa",
+        "ceiaaaaaaaaaaaaaaaaaaaaaaaaaaaaa",
+    ]
+    responsible_hsdirs = consensus.get_hsdirs_many(descriptor_ids)
+
+    assert responsible_hsdirs == [consensus.get_hsdirs(descriptor_id)
+                                  for descriptor_id in descriptor_ids]
+    assert responsible_hsdirs[0] == [
+        "6666666666666666666666666666666666666666",
+        "1111111111111111111111111111111111111111",
+        "2222222222222222222222222222222222222222",
+    ]
+
+
+CACHED_CONSENSUS = u'\n'.join([
+    "network-status-version 3 microdesc",
+    "vote-status consensus",
+    "valid-after 2016-05-01 11:00:00",
+    "fresh-until 2016-05-01 12:00:00",
+    "valid-until 2016-05-01 14:00:00",
+    "r relay1 ERERERERERERERERERERERERERE 2016-05-01 02:27:21 "
+    "10.0.0.1 9001 0",
+    "m 3xqtAJwY2uqgiVtGaEd7qTrF6nEUNtY8jRvXyglOUjY",
+    "s Fast HSDir Running Stable V2Dir Valid",
+    "r relay2 IiIiIiIiIiIiIiIiIiIiIiIiIiI 2016-05-01 05:05:05 "
+    "10.0.0.2 443 80",
+    "s Fast Running Stable Valid",
+    "r relay3 MzMzMzMzMzMzMzMzMzMzMzMzMzM 2016-05-01 08:37:57 "
+    "10.0.0.3 9001 9030",
+    "s Exit Fast Guard HSDir Running Stable V2Dir Valid",
+    "w Bandwidth=2670",
+    "r relay4 REREREREREREREREREREREREREQ 2016-05-01 10:11:12 "
+    "10.0.0.4 9001 0",
+    "s Fast Guard HSDir Running V2Dir Valid",
+    "directory-footer",
+    "bandwidth-weights Wbd=0",
+    "",
+])
+
+
+def test_load_hsdir_ring(tmpdir):
+    """Test reading the HSDirs directly from a cached consensus file"""
+
+    tmpdir.join('cached-microdesc-consensus').write(CACHED_CONSENSUS)
+    consensus_path = consensus.find_consensus_file(str(tmpdir))
+    assert consensus_path == str(tmpdir.join('cached-microdesc-consensus'))
+
+    hsdir_ring = consensus.load_hsdir_ring(consensus_path)
+    assert list(hsdir_ring) == [
+        "1111111111111111111111111111111111111111",
+        "3333333333333333333333333333333333333333",
+        "4444444444444444444444444444444444444444",
+    ]
+
+
+def test_refresh_consensus_from_data_directory(monkeypatch, tmpdir):
+    """Test that the HSDir ring is loaded from the cached consensus"""
+
+    tmpdir.join('cached-consensus').write(CACHED_CONSENSUS)
+    monkeypatch.setattr(config, 'TOR_DATA_DIRECTORY', str(tmpdir))
+    monkeypatch.setattr(consensus, 'HSDIR_LIST',
+                        consensus.HSDirRing(MOCK_HSDIR_LIST))
+
+    changes = consensus.refresh_consensus()
+    assert changes.joined == set()
+    assert changes.left == set([
+        "2222222222222222222222222222222222222222",
+        "5555555555555555555555555555555555555555",
+        "6666666666666666666666666666666666666666",
+    ])
+    assert len(consensus.HSDIR_LIST) == 3
+
+
+def test_find_consensus_file_missing(tmpdir):
+    assert consensus.find_consensus_file(str(tmpdir)) is None
+
+
+def test_consensus_refresher_coalesces_requests(mocker):
+    """
+    Test that refresh requests which arrive during a refresh are coalesced
+    into a single follow-up refresh.
+    """
+    refresh_started = threading.Event()
+    release_refresh = threading.Event()
+
+    def slow_refresh():
+        refresh_started.set()
+        release_refresh.wait(5)
+
+    mock_refresh = mocker.patch('onionbalance.consensus.refresh_consensus',
+                                side_effect=slow_refresh)
+
+    refresher = consensus.ConsensusRefresher()
+    refresher.request_refresh()
+    assert refresh_started.wait(5)
+
+    # Requests received during the running refresh
+    for _ in range(3):
+        refresher.request_refresh()
+    release_refresh.set()
+
+    assert refresher.wait_idle(5)
+    assert mock_refresh.call_count == 2
+
+
+def test_load_hsdir_ring_valid_times(tmpdir):
+    """Test reading the consensus validity times from the cached consensus"""
+
+    tmpdir.join('cached-consensus').write(CACHED_CONSENSUS)
+    consensus_path = str(tmpdir.join('cached-consensus'))
+    hsdir_ring = consensus.load_hsdir_ring(consensus_path)
+
+    assert hsdir_ring.valid_after == 1462100400  # 2016-05-01 11:00:00
+    assert hsdir_ring.valid_until == 1462111200  # 2016-05-01 14:00:00
+
+
+def test_hsdir_ring_snapshot(monkeypatch, tmpdir):
+    """Test saving and restoring a HSDir ring snapshot"""
+
+    snapshot_path = str(tmpdir.join('hsdir-ring'))
+    hsdir_ring = consensus.HSDirRing(MOCK_HSDIR_LIST,
+                                     valid_after=1462100400,
+                                     valid_until=1462111200)
+    assert consensus.save_snapshot(snapshot_path, hsdir_ring)
+
+    # Snapshot is loaded while its consensus is still valid
+    monkeypatch.setattr(consensus.time, 'time', lambda: 1462105000)
+    loaded_ring = consensus.load_snapshot(snapshot_path)
+    assert list(loaded_ring) == MOCK_HSDIR_LIST
+    assert loaded_ring.valid_after == 1462100400
+    assert loaded_ring.valid_until == 1462111200
+
+    monkeypatch.setattr(config, 'CONSENSUS_SNAPSHOT_LOCATION', snapshot_path)
+    assert consensus.restore_snapshot()
+    assert list(consensus.HSDIR_LIST) == MOCK_HSDIR_LIST
+
+    # Expired snapshots are ignored
+    monkeypatch.setattr(consensus.time, 'time', lambda: 1462111200)
+    assert consensus.load_snapshot(snapshot_path) is None
+
+
+def test_hsdir_ring_snapshot_corrupt(tmpdir):
+    snapshot_path = tmpdir.join('hsdir-ring')
+    snapshot_path.write(b'not-a-snapshot', mode='wb')
+    assert consensus.load_snapshot(str(snapshot_path)) is None
+    assert consensus.load_snapshot(str(tmpdir.join('missing'))) is None
+
+
+def test_get_hsdirs_with_previous(monkeypatch):
+    """
+    Test that HSDirs responsible in the previous consensus are included
+    during the grace period, without repeating HSDirs in both rings.
+    """
+    monkeypatch.setattr(consensus, 'HSDIR_LIST',
+                        consensus.HSDirRing(MOCK_HSDIR_LIST))
+    monkeypatch.setattr(config, 'HSDIR_GRACE_PERIOD', 3600)
+
+    new_hsdirs = list(MOCK_HSDIR_LIST)
+    new_hsdirs.remove("3333333333333333333333333333333333333333")
+    consensus.update_hsdir_list(new_hsdirs)
+
+    # Descriptor ID before '222....''
+    descriptor_id_base32 = "eiqaaaaaaaaaaaaaaaaaaaaaaaaaaaaa"
+    assert consensus.get_previous_hsdirs(descriptor_id_base32) == [
+        "3333333333333333333333333333333333333333",
+    ]
+    assert consensus.get_hsdirs_with_previous(descriptor_id_base32) == [
+        "2222222222222222222222222222222222222222",
+        "4444444444444444444444444444444444444444",
+        "5555555555555555555555555555555555555555",
+        "3333333333333333333333333333333333333333",
+    ]
+
+    # The previous ring is not used once the grace period has passed
+    monkeypatch.setattr(consensus, 'HSDIR_LIST_UPDATED',
+                        consensus.HSDIR_LIST_UPDATED - 3601)
+    assert consensus.get_previous_hsdirs(descriptor_id_base32) == []
+
+
+def test_get_new_hsdirs(monkeypatch):
+    """
+    Test that only HSDirs which became responsible in the latest consensus
+    are returned.
+    """
+    # Descriptor ID before '222....''
+    descriptor_id_base32 = "eiqaaaaaaaaaaaaaaaaaaaaaaaaaaaaa"
+
+    # Every HSDir is new on the first consensus, but they were uploaded
+    # to when the descriptor was published.
+    consensus.update_hsdir_list(MOCK_HSDIR_LIST)
+    assert consensus.get_new_hsdirs(descriptor_id_base32) == []
+
+    new_hsdirs = list(MOCK_HSDIR_LIST)
+    new_hsdirs.remove("3333333333333333333333333333333333333333")
+    consensus.update_hsdir_list(new_hsdirs)
+    assert consensus.get_new_hsdirs(descriptor_id_base32) == [
+        "5555555555555555555555555555555555555555",
+    ]
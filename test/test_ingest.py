@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+import time
+
+import pytest
+
+from onionbalance import config
+from onionbalance import descriptor
+from onionbalance import ingest
+import onionbalance.instance
+
+from .test_descriptor import PRIVATE_KEY, INTRODUCTION_POINT_PART
+
+
+def test_descriptor_queue():
+    """
+    Test that the queue keeps the newest descriptor for each instance
+    """
+    queue = ingest.DescriptorQueue(maxsize=2)
+    queue.put('instance1', b'descriptor-1a', now=10)
+    queue.put('instance2', b'descriptor-2a', now=11)
+    queue.put('instance1', b'descriptor-1b', now=12)
+    assert len(queue) == 2
+
+    # The newer descriptor keeps the place of the replaced one
+    assert queue.get() == ('instance1', b'descriptor-1b', 10)
+
+    # Descriptors are not handed out while the address is being processed
+    queue.put('instance1', b'descriptor-1c', now=13)
+    assert queue.get() == ('instance2', b'descriptor-2a', 11)
+    assert queue.get(timeout=0) is None
+    queue.task_done('instance1', 10, 14, now=15)
+    assert queue.get(timeout=0) == ('instance1', b'descriptor-1c', 13)
+
+    # The oldest descriptor is dropped when the queue is full
+    queue.put('instance3', b'descriptor-3a', now=16)
+    queue.put('instance4', b'descriptor-4a', now=17)
+    queue.put('instance5', b'descriptor-5a', now=18)
+    assert queue.get(timeout=0)[0] == 'instance4'
+
+    stats = queue.stats()
+    assert stats.depth == 1
+    assert (stats.received, stats.processed) == (7, 1)
+    assert (stats.replaced, stats.dropped) == (1, 1)
+    assert stats.latency == 5
+    assert stats.processing_time == 1
+
+
+def test_ingester_workers(mocker, monkeypatch):
+    """
+    Test that submitted descriptors are processed by the worker threads
+    """
+    mocker.patch('onionbalance.descriptor.descriptor_received')
+    monkeypatch.setattr(config, 'instances_by_address', {})
+    ingester = ingest.DescriptorIngester()
+
+    # Descriptors are processed immediately without worker threads
+    ingester.submit('instance1', b'descriptor-1a')
+    descriptor.descriptor_received.assert_called_once_with(b'descriptor-1a')
+
+    ingester.start(workers=2)
+    ingester.submit('instance1', b'descriptor-1b')
+    ingester.submit('instance2', b'descriptor-2a')
+    for _ in range(100):
+        if ingester.queue.stats().processed == 2:
+            break
+        time.sleep(0.01)
+
+    assert ingester.queue.stats().processed == 2
+    assert descriptor.descriptor_received.call_count == 3
+    for call in descriptor.descriptor_received.call_args_list[1:]:
+        assert call[1] == {'parser': ingester._parse}
+
+
+def test_ingester_parsing_pool(mocker, monkeypatch):
+    """
+    Test parsing descriptors in the worker processes
+    """
+    mocker.patch('onionbalance.descriptor._make_introduction_points_part',
+                 lambda *_: INTRODUCTION_POINT_PART.encode('utf-8'))
+    descriptor_content = descriptor.generate_service_descriptor(
+        PRIVATE_KEY,
+        introduction_point_list=['mocked-ip-list'],
+    ).encode('utf-8')
+
+    service_instance = onionbalance.instance.Instance(
+        None, 'instance1', authentication_cookie='cookie')
+    monkeypatch.setattr(config, 'instances_by_address',
+                        {'instance1': [service_instance]})
+
+    # A thread is started for each parsing process
+    ingester = ingest.DescriptorIngester()
+    ingester.start(workers=1, processes=2)
+    try:
+        assert ingester.pool is not None
+        assert len(ingester._threads) == 2
+
+        # The introduction points are encrypted, decoding them without the
+        # cookie fails and is left to the instance
+        parsed_descriptor, decoded = ingester._parser('unknown')(
+            descriptor_content)
+        assert (parsed_descriptor.permanent_key ==
+                descriptor.parse_descriptor(
+                    descriptor_content)[0].permanent_key)
+        assert decoded is None
+
+        # The instance's authentication cookie is used for decoding
+        assert ingester._parser('instance1').keywords == {
+            'authentication_cookie': 'cookie'}
+
+        with pytest.raises(ValueError):
+            ingester._parse(b'not-a-valid-descriptor-input')
+    finally:
+        ingester.stop()
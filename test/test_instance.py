@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+import collections
+import datetime
+
+from onionbalance import descriptor
+from onionbalance import instance
+
+IntroPoint = collections.namedtuple('IntroPoint', 'identifier')
+
+
+def _parsed_descriptor(mocker, published, encoded, identifiers):
+    parsed_descriptor = mocker.Mock()
+    parsed_descriptor.published = published
+    parsed_descriptor.introduction_points_encoded = encoded
+    parsed_descriptor.introduction_points.return_value = [
+        IntroPoint(identifier) for identifier in identifiers]
+    return parsed_descriptor
+
+
+def test_update_descriptor_unchanged_intro_points(mocker):
+    """
+    Test that introduction points are only decoded when they change
+    """
+    published = datetime.datetime(2016, 5, 1, 11, 0, 0)
+    service_instance = instance.Instance(None, 'instance1')
+
+    parsed_descriptor = _parsed_descriptor(mocker, published, 'blob-a',
+                                           ['ip1', 'ip2'])
+    assert service_instance.update_descriptor(parsed_descriptor)
+    assert parsed_descriptor.introduction_points.call_count == 1
+
+    # A newer descriptor with the same encoded introduction points
+    published += datetime.timedelta(hours=1)
+    parsed_descriptor = _parsed_descriptor(mocker, published, 'blob-a',
+                                           ['ip1', 'ip2'])
+    assert not service_instance.update_descriptor(parsed_descriptor)
+    assert not parsed_descriptor.introduction_points.called
+    assert service_instance.timestamp == published
+    assert ([ip.identifier for ip in service_instance.introduction_points] ==
+            ['ip1', 'ip2'])
+
+    # Changed introduction points are decoded
+    published += datetime.timedelta(hours=1)
+    parsed_descriptor = _parsed_descriptor(mocker, published, 'blob-b',
+                                           ['ip1', 'ip3'])
+    assert service_instance.update_descriptor(parsed_descriptor)
+    assert ([ip.identifier for ip in service_instance.introduction_points] ==
+            ['ip1', 'ip3'])
+
+
+def test_update_descriptor_decoded_intro_points(mocker):
+    """
+    Test using introduction points decoded by a parsing process
+    """
+    published = datetime.datetime(2016, 5, 1, 11, 0, 0)
+    service_instance = instance.Instance(None, 'instance1',
+                                         authentication_cookie='cookie')
+
+    parsed_descriptor = _parsed_descriptor(mocker, published, 'blob-a',
+                                           ['ip1'])
+    decoded = descriptor.DecodedIntroductionPoints(
+        'cookie', [IntroPoint('ip2')])
+    assert service_instance.update_descriptor(parsed_descriptor, decoded)
+    assert not parsed_descriptor.introduction_points.called
+    assert ([ip.identifier for ip in service_instance.introduction_points] ==
+            ['ip2'])
+
+    # Introduction points decoded with a different cookie are not used
+    published += datetime.timedelta(hours=1)
+    parsed_descriptor = _parsed_descriptor(mocker, published, 'blob-b',
+                                           ['ip1'])
+    decoded = descriptor.DecodedIntroductionPoints(None, [IntroPoint('ip3')])
+    assert service_instance.update_descriptor(parsed_descriptor, decoded)
+    parsed_descriptor.introduction_points.assert_called_once_with(
+        authentication_cookie='cookie')
+    assert ([ip.identifier for ip in service_instance.introduction_points] ==
+            ['ip1'])
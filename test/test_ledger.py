@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from onionbalance import config
+from onionbalance.ledger import HSDirLedger
+
+FAST_HSDIR = "1111111111111111111111111111111111111111"
+SLOW_HSDIR = "2222222222222222222222222222222222222222"
+FAILING_HSDIR = "3333333333333333333333333333333333333333"
+UNKNOWN_HSDIR = "4444444444444444444444444444444444444444"
+
+
+@pytest.fixture
+def ledger(monkeypatch):
+    monkeypatch.setattr(config, 'HSDIR_LEDGER_HALF_LIFE', 100)
+    return HSDirLedger()
+
+
+def test_ledger_latency(ledger):
+    ledger.record_event('UPLOAD', FAST_HSDIR, now=1000)
+    ledger.record_event('UPLOADED', FAST_HSDIR, now=1001)
+    ledger.record_event('REQUESTED', FAST_HSDIR.lower(), now=1001)
+    ledger.record_event('RECEIVED', FAST_HSDIR, now=1003)
+
+    hsdir = ledger.stats(now=1003)[0]
+    assert hsdir.fingerprint == FAST_HSDIR
+    assert hsdir.successes == pytest.approx(2, rel=0.05)
+    assert hsdir.failures == 0
+    assert hsdir.latency == pytest.approx(1.3)
+
+
+def test_ledger_decay(ledger):
+    ledger.record_event('RECEIVED', FAST_HSDIR, now=1000)
+    ledger.record_event('FAILED', FAST_HSDIR, now=1000)
+    ledger.record_event('IGNORE', FAST_HSDIR, now=1000)
+
+    hsdir = ledger.stats(now=1200)[0]
+    assert hsdir.successes == pytest.approx(0.25)
+    assert hsdir.failures == pytest.approx(0.25)
+    assert hsdir.latency is None
+
+
+def test_ledger_sort_hsdirs(ledger):
+    for hsdir, latency in [(FAST_HSDIR, 1), (SLOW_HSDIR, 10),
+                           (FAILING_HSDIR, 2)]:
+        ledger.record_event('UPLOAD', hsdir, now=1000)
+        ledger.record_event('FAILED' if hsdir == FAILING_HSDIR
+                            else 'UPLOADED', hsdir, now=1000 + latency)
+
+    # HSDirs without any outcomes are expected to be as fast as the median
+    # HSDir, after proven fast HSDirs and before slow ones
+    assert ledger.sort_hsdirs([FAILING_HSDIR, SLOW_HSDIR, FAST_HSDIR,
+                               UNKNOWN_HSDIR]) == [
+        FAST_HSDIR, UNKNOWN_HSDIR, FAILING_HSDIR, SLOW_HSDIR]
+    assert [hsdir.fingerprint for hsdir in ledger.stats(now=1010)] == [
+        FAST_HSDIR, FAILING_HSDIR, SLOW_HSDIR]
+
+    # An outcome without a matching request does not measure the latency
+    ledger.record_event('RECEIVED', UNKNOWN_HSDIR, now=1010)
+    assert ledger.sort_hsdirs([SLOW_HSDIR, UNKNOWN_HSDIR, FAST_HSDIR]) == [
+        FAST_HSDIR, UNKNOWN_HSDIR, SLOW_HSDIR]
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+import collections
+import datetime
+import time
+
+import pytest
+import Crypto.PublicKey.RSA
+
+from onionbalance import config
+from onionbalance import consensus
+from onionbalance import descriptor
+from onionbalance import service
+import onionbalance.instance
+
+from .test_consensus import MOCK_HSDIR_LIST
+from .test_descriptor import PEM_PRIVATE_KEY
+
+IntroPoint = collections.namedtuple('IntroPoint', 'identifier')
+
+
+@pytest.fixture
+def onion_service(mocker):
+    mocker.patch('onionbalance.service.Service._upload_descriptor')
+    return service.Service(
+        controller=None,
+        service_key=Crypto.PublicKey.RSA.importKey(PEM_PRIVATE_KEY),
+    )
+
+
+def test_upload_to_new_hsdirs(monkeypatch, onion_service):
+    """
+    Test that stored descriptors are uploaded to HSDirs which became
+    responsible without signing new descriptors.
+    """
+    monkeypatch.setattr(config, 'HSDIR_SET', 3)
+    consensus.update_hsdir_list(MOCK_HSDIR_LIST)
+
+    descriptor_id = onion_service.descriptor_ids()[0]
+    responsible_hsdirs = consensus.get_hsdirs(descriptor_id)
+    onion_service._record_published_descriptors({
+        'expiredexpiredexpiredexpiredexpi': (1, ['descriptor-c']),
+    })
+    onion_service._record_published_descriptors({
+        descriptor_id: (0, ['descriptor-a', 'descriptor-b']),
+    })
+
+    # Descriptors for descriptor IDs which are no longer current are dropped
+    assert list(onion_service.published_descriptors) == [descriptor_id]
+
+    # Nothing is uploaded when the responsible HSDirs have not changed
+    monkeypatch.setattr(config, 'services', [onion_service])
+    consensus.update_hsdir_list(list(reversed(MOCK_HSDIR_LIST)))
+    service.upload_to_new_hsdirs()
+    assert not onion_service._upload_descriptor.called
+
+    # Replace the first responsible HSDir with one just before it
+    replaced_hsdir = responsible_hsdirs[0]
+    new_hsdir = '%040X' % (int(replaced_hsdir, 16) - 1)
+    new_hsdirs = [hsdir for hsdir in consensus.HSDIR_LIST
+                  if hsdir != replaced_hsdir] + [new_hsdir]
+    consensus.update_hsdir_list(new_hsdirs)
+
+    service.upload_to_new_hsdirs()
+    onion_service._upload_descriptor.assert_called_once_with(
+        'descriptor-a', 0, hsdirs=new_hsdir)
+
+
+def _instance_with_intro_points(onion_address, count):
+    instance = onionbalance.instance.Instance(None, onion_address)
+    instance.introduction_points = [
+        IntroPoint('{}-ip{}'.format(onion_address, i)) for i in range(count)]
+    instance.received = datetime.datetime.utcnow()
+    instance.timestamp = datetime.datetime.utcnow()
+    return instance
+
+
+def test_plan_descriptors(monkeypatch, onion_service):
+    """
+    Test planning a publish cycle without a Tor controller
+    """
+    monkeypatch.setattr(config, 'HSDIR_SET', 3)
+    monkeypatch.setattr(config, 'REPLICAS', 2)
+    monkeypatch.setattr(config, 'DISTINCT_DESCRIPTORS', True)
+    monkeypatch.setattr(consensus, 'HSDIR_LIST',
+                        consensus.HSDirRing(MOCK_HSDIR_LIST))
+
+    # Distinct descriptors are planned for each responsible HSDir
+    onion_service.instances = [_instance_with_intro_points(address, 6)
+                               for address in ['instance1', 'instance2']]
+    plan = onion_service.plan_descriptors(deviations=[0, 1])
+    assert len(plan) == 2 * 2 * 3
+    assert set(item.descriptor_id for item in plan) == set(
+        onion_service.descriptor_ids() +
+        onion_service.descriptor_ids(deviation=1))
+    for item in plan:
+        assert item.hsdirs[0] in consensus.get_hsdirs(item.descriptor_id)
+        assert len(item.introduction_points) == config.MAX_INTRO_POINTS
+
+    # One descriptor for each replica is uploaded to the HSDirs Tor picks
+    onion_service.instances = [_instance_with_intro_points('instance1', 3)]
+    plan = onion_service.plan_descriptors()
+    assert [(item.replica, item.hsdirs) for item in plan] == [
+        (0, [None]), (1, [None])]
+    assert len(plan[0].introduction_points) == 3
+
+
+def test_publish_descriptors(monkeypatch, mocker, onion_service):
+    """
+    Test that the planned descriptors are generated, signed and uploaded
+    """
+    monkeypatch.setattr(config, 'REPLICAS', 2)
+    mocker.patch('onionbalance.descriptor._make_introduction_points_part',
+                 lambda *_: b'')
+    mocker.patch.object(onion_service, '_descriptor_id_changing_soon',
+                        return_value=False)
+    onion_service.instances = [_instance_with_intro_points('instance1', 3)]
+
+    onion_service.descriptor_publish(force_publish=True)
+    assert onion_service.uploaded is not None
+    uploads = onion_service._upload_descriptor.call_args_list
+    assert [(upload[0][1], upload[1]) for upload in uploads] == [
+        (0, {'hsdirs': None}), (1, {'hsdirs': None})]
+    for upload in uploads:
+        assert upload[0][0].startswith(b'rendezvous-service-descriptor ')
+        assert b'-----BEGIN SIGNATURE-----' in upload[0][0]
+    assert (sorted(onion_service.published_descriptors) ==
+            sorted(onion_service.descriptor_ids()))
+
+
+@pytest.mark.parametrize('num_intro_points', [3, 12])
+def test_republish_descriptors_cached(monkeypatch, mocker, onion_service,
+                                      num_intro_points):
+    """
+    Test that republishing descriptors with unchanged introduction points
+    reuses the signatures of the previous publish
+    """
+    monkeypatch.setattr(config, 'HSDIR_SET', 3)
+    monkeypatch.setattr(config, 'REPLICAS', 2)
+    monkeypatch.setattr(config, 'DISTINCT_DESCRIPTORS', True)
+    monkeypatch.setattr(consensus, 'HSDIR_LIST',
+                        consensus.HSDirRing(MOCK_HSDIR_LIST))
+    mocker.patch('onionbalance.descriptor.serialize_introduction_point',
+                 lambda intro_point: intro_point.identifier.encode('utf-8'))
+    mocker.patch.object(onion_service, '_descriptor_id_changing_soon',
+                        return_value=False)
+    onion_service.instances = [
+        _instance_with_intro_points(address, num_intro_points // 2)
+        for address in ['instance1', 'instance2']]
+    descriptor.signature_cache.clear()
+
+    onion_service.descriptor_publish(force_publish=True)
+    uploads = onion_service._upload_descriptor.call_args_list
+    signed = len(uploads)
+    assert descriptor.signature_cache.info().misses == signed
+
+    onion_service._upload_descriptor.reset_mock()
+    onion_service.descriptor_publish(force_publish=True)
+    assert onion_service._upload_descriptor.call_args_list == uploads
+    assert descriptor.signature_cache.info().hits == signed
+    assert descriptor.signature_cache.info().misses == signed
+
+    # Changed introduction points are signed again
+    onion_service.instances[0].introduction_points.pop()
+    onion_service.descriptor_publish(force_publish=True)
+    assert descriptor.signature_cache.info().misses > signed
+
+
+def test_next_descriptor_ids(monkeypatch, onion_service):
+    """
+    Test that the key material is only refreshed explicitly
+    """
+    monkeypatch.setattr(config, 'REPLICAS', 2)
+    key_material = onion_service.key_material._replace(
+        next_rotation=int(time.time()) - 10)
+    onion_service.key_material = key_material
+
+    # The ID is not reported as changing until the key material is refreshed
+    monkeypatch.setattr(config, 'DESCRIPTOR_OVERLAP_PERIOD', 0)
+    assert onion_service._descriptor_id_changing_soon()
+    assert onion_service.key_material is key_material
+
+    onion_service.refresh_key_material()
+    assert onion_service.key_material.next_rotation > time.time()
+    assert not onion_service._descriptor_id_changing_soon()
+    assert onion_service.next_descriptor_ids() == []
+
+    monkeypatch.setattr(config, 'DESCRIPTOR_OVERLAP_PERIOD', 86400)
+    assert (onion_service.next_descriptor_ids() ==
+            onion_service.descriptor_ids(deviation=1))
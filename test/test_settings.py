@@ -48,3 +48,73 @@ def test_parse_config_file_valid(mocker):
 def test_parse_config_file_does_not_exist(mocker):
     with pytest.raises(SystemExit):
         settings.parse_config_file('doesnotexist/config.yaml')
+
+
+def test_apply_config_options(monkeypatch):
+    from onionbalance import config
+
+    monkeypatch.setattr(config, 'INGEST_WORKERS', 4)
+    monkeypatch.setattr(config, 'DISTINCT_DESCRIPTORS', True)
+    monkeypatch.setattr(config, 'LOG_LOCATION', None)
+    monkeypatch.setattr(config, 'REPLICAS', 2)
+
+    # Options set to false, 0 or an empty string are applied, options
+    # without a value keep their default
+    settings.apply_config_options({
+        'INGEST_WORKERS': 0,
+        'DISTINCT_DESCRIPTORS': False,
+        'LOG_LOCATION': '',
+        'REPLICAS': None,
+        'services': [],
+    })
+    assert config.INGEST_WORKERS == 0
+    assert config.DISTINCT_DESCRIPTORS is False
+    assert config.LOG_LOCATION == ''
+    assert config.REPLICAS == 2
+
+
+def test_initialize_services_weights(mocker, monkeypatch):
+    from onionbalance import config
+    from .test_descriptor import PRIVATE_KEY
+
+    monkeypatch.setattr(config, 'services', [])
+    mocker.patch('onionbalance.util.key_decrypt_prompt',
+                 return_value=PRIVATE_KEY)
+
+    services_config = [{'key': 'private.key', 'instances': [
+        {'address': 'fqyw6ojo2voercr7', 'weight': 4},
+        {'address': 'facebookcorewwwi'},
+    ]}]
+    settings.initialize_services(None, services_config)
+    assert [instance.weight for instance in
+            config.services[0].instances] == [4, 1]
+
+    services_config[0]['instances'][0]['weight'] = 0
+    with pytest.raises(SystemExit):
+        settings.initialize_services(None, services_config)
+
+
+def test_initialize_services_index(mocker, monkeypatch):
+    from onionbalance import config
+    from .test_descriptor import PRIVATE_KEY
+
+    monkeypatch.setattr(config, 'services', [])
+    monkeypatch.setattr(config, 'instances_by_address', {})
+    mocker.patch('onionbalance.util.key_decrypt_prompt',
+                 return_value=PRIVATE_KEY)
+
+    # The same instance is configured under two services
+    services_config = [
+        {'key': 'private.key', 'instances': [
+            {'address': 'fqyw6ojo2voercr7.onion'},
+            {'address': 'facebookcorewwwi'}]},
+        {'key': 'private.key', 'instances': [
+            {'address': 'fqyw6ojo2voercr7'}]},
+    ]
+    settings.initialize_services(None, services_config)
+    assert sorted(config.instances_by_address) == [
+        'facebookcorewwwi', 'fqyw6ojo2voercr7']
+    indexed = config.instances_by_address['fqyw6ojo2voercr7']
+    assert len(indexed) == 2
+    assert indexed[0] is config.services[0].instances[0]
+    assert indexed[1] is config.services[1].instances[0]
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+import pytest
+import Crypto.PublicKey.RSA
+
+from onionbalance import descriptor
+from onionbalance import signing
+
+from .test_descriptor import PEM_PRIVATE_KEY
+
+PRIVATE_KEY = Crypto.PublicKey.RSA.importKey(PEM_PRIVATE_KEY)
+
+UNSIGNED_DESCRIPTORS = [
+    'rendezvous-service-descriptor {}\nsignature\n'.format(i)
+    for i in range(4)
+] + ['descriptor-without-signature-line']
+
+
+@pytest.fixture
+def signing_pool():
+    signing.start_pool(2)
+    yield signing.pool
+    signing.stop_pool()
+
+
+def test_sign_descriptors_in_process():
+    assert signing.pool is None
+    assert signing.sign_descriptors(UNSIGNED_DESCRIPTORS, PRIVATE_KEY) == [
+        descriptor.sign_descriptor(unsigned_descriptor, PRIVATE_KEY)
+        for unsigned_descriptor in UNSIGNED_DESCRIPTORS]
+
+
+def test_sign_descriptors_pool(mocker, signing_pool):
+    assert signing_pool is not None
+    signed_descriptors = [
+        descriptor.sign_descriptor(unsigned_descriptor, PRIVATE_KEY)
+        for unsigned_descriptor in UNSIGNED_DESCRIPTORS]
+    descriptor.signature_cache.clear()
+
+    # The signatures are made in the worker processes
+    mocker.patch('onionbalance.descriptor.make_signature_block',
+                 side_effect=AssertionError)
+    assert signing.sign_descriptors(UNSIGNED_DESCRIPTORS,
+                                    PRIVATE_KEY) == signed_descriptors
+
+
+def test_sign_descriptors_cached(mocker):
+    descriptor.signature_cache.clear()
+    signed_descriptors = signing.sign_descriptors(UNSIGNED_DESCRIPTORS[:2],
+                                                  PRIVATE_KEY)
+    assert descriptor.signature_cache.info().misses == 2
+
+    # Identical descriptors reuse the cached signatures
+    mocker.spy(descriptor, 'make_signature_block')
+    assert signing.sign_descriptors(UNSIGNED_DESCRIPTORS[:3],
+                                    PRIVATE_KEY)[:2] == signed_descriptors
+    assert descriptor.make_signature_block.call_count == 1
+    assert (descriptor.sign_descriptor(UNSIGNED_DESCRIPTORS[0], PRIVATE_KEY) ==
+            signed_descriptors[0])
+    assert descriptor.make_signature_block.call_count == 1
+    assert descriptor.signature_cache.info().hits == 3
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+from onionbalance import config
+from onionbalance import consensus
+from onionbalance import simulate
+from onionbalance import util
+
+from .test_consensus import MOCK_HSDIR_LIST
+
+
+def test_synthetic_onion_addresses():
+    onion_addresses = simulate.synthetic_onion_addresses(5, seed=1)
+    assert len(set(onion_addresses)) == 5
+    assert all(len(address) == 16 for address in onion_addresses)
+    assert simulate.synthetic_onion_addresses(5, seed=1) == onion_addresses
+
+
+def test_simulate(monkeypatch):
+    monkeypatch.setattr(consensus, 'HSDIR_LIST',
+                        consensus.HSDirRing(MOCK_HSDIR_LIST))
+    monkeypatch.setattr(config, 'HSDIR_SET', 3)
+    monkeypatch.setattr(config, 'REPLICAS', 2)
+
+    onion_addresses = simulate.synthetic_onion_addresses(4, seed=1)
+    result = simulate.simulate(onion_addresses, start=1462100400, days=1,
+                               distinct_descriptors=True)
+
+    # Every publish uploads one distinct descriptor to each responsible
+    # HSDir for each replica, plus the next descriptor IDs when rotating.
+    uploads = sum(result.fan_in.values())
+    assert uploads == sum(burst.uploads for burst in result.bursts)
+    assert uploads == sum(result.signatures_per_day.values())
+    assert sum(burst.rotating for burst in result.bursts) >= 4
+    assert max(result.services_per_hsdir.values()) <= 4
+
+    # Services publish together after the initial delay
+    first_burst = result.bursts[0]
+    assert first_burst.time == 1462100400 + config.INITIAL_DELAY
+    assert first_burst.uploads >= 4 * 2 * 3
+
+    lines = simulate.format_report(result, len(onion_addresses), top=3)
+    assert lines[0] == "Simulated 4 services on 6 HSDirs."
+
+
+def test_load_onion_addresses(monkeypatch, mocker):
+    from .test_descriptor import PRIVATE_KEY
+
+    monkeypatch.setattr(config, 'DISTINCT_DESCRIPTORS', True)
+    monkeypatch.setattr(config, 'INGEST_WORKERS', 1)
+    monkeypatch.setattr(config, 'TOR_CONTROL_PASSWORD', 'password')
+    mocker.patch('onionbalance.settings.parse_config_file', return_value={
+        'DISTINCT_DESCRIPTORS': False,
+        'INGEST_WORKERS': 0,
+        'TOR_CONTROL_PASSWORD': None,
+        'services': [{'key': 'private.key'}],
+    })
+    mocker.patch('onionbalance.util.key_decrypt_prompt',
+                 return_value=PRIVATE_KEY)
+
+    assert simulate.load_onion_addresses('config.yaml') == [
+        util.calc_onion_address(PRIVATE_KEY)]
+
+    # Options set to false or 0 override the defaults, empty options do not
+    assert config.DISTINCT_DESCRIPTORS is False
+    assert config.INGEST_WORKERS == 0
+    assert config.TOR_CONTROL_PASSWORD == 'password'
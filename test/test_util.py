@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 from binascii import hexlify, unhexlify
 import base64
+import hashlib
 import datetime
 import io
 import sys
@@ -295,3 +296,54 @@ def test_is_directory_empty_not_empty(mocker):
     # Directory is empty
     mocker.patch('os.listdir', return_value=['filename'])
     assert not is_directory_empty('dir_not_empty/')
+
+
+def test_lru_cache():
+    cache = LRUCache(maxsize=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+
+    # 'b' is the least recently used entry
+    cache.set('c', 3)
+    assert 'b' not in cache
+    assert cache.get('b') is None
+    assert cache.get('c') == 3
+    assert cache.info() == CacheInfo(hits=2, misses=1, maxsize=2, currsize=2)
+
+    cache.maxsize = 0
+    cache.set('a', 1)
+    assert 'a' not in cache
+
+
+def test_crypto_backend():
+    private_key = Crypto.PublicKey.RSA.importKey(PEM_PRIVATE_KEY)
+    backend = get_crypto_backend()
+    assert backend.name == 'pycrypto'
+    digest = hashlib.sha1(b'descriptor').digest()
+
+    signature = backend.sign(private_key, digest)
+    assert (pow(Crypto.Util.number.bytes_to_long(signature), private_key.e,
+                private_key.n) ==
+            Crypto.Util.number.bytes_to_long(add_pkcs1_padding(digest)))
+    assert (backend.public_key_der(private_key.publickey()) ==
+            backend.public_key_der(private_key))
+    assert (backend.key_digest(private_key) ==
+            hashlib.sha1(backend.public_key_der(private_key)).digest())
+
+    with pytest.raises(ValueError):
+        get_crypto_backend('unknown')
+
+
+def test_crypto_backend_faulty_signature(mocker):
+    """
+    Test that a signature which does not verify is never returned
+    """
+    private_key = Crypto.PublicKey.RSA.importKey(PEM_PRIVATE_KEY)
+    digest = hashlib.sha1(b'descriptor').digest()
+    (signature_long, ) = private_key.sign(add_pkcs1_padding(digest), None)
+    mocker.patch.object(private_key, 'sign',
+                        return_value=(signature_long ^ 1, ))
+
+    with pytest.raises(ValueError):
+        get_crypto_backend().sign(private_key, digest)